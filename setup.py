@@ -46,5 +46,6 @@ setup(
     update_search_preprint=updatepreprint.updatepreprint:main
     update_search_accesses=updatesearch.accesses:main
     update_search_citations=updatesearch.citations:main
+    update_search_indicators=updatesearch.totals:main
     """
 )
@@ -0,0 +1,117 @@
+# coding: utf-8
+import re
+import copy
+import json
+import logging
+import logging.config
+
+from lxml import etree as ET
+
+
+class FakeSolr(object):
+    """
+    Search index holding ``docs``, exported sorted by id with cursorMark or
+    looked up by the quoted ids of an ``id:(...)`` query. The params of each
+    select and the body of each update are recorded.
+    """
+
+    def __init__(self, docs=()):
+        self.docs = sorted(docs, key=lambda i: i['id'])
+        self.requests = []
+        self.updates = []
+        self.url = 'http://solr'
+
+    def select(self, params, format='json'):
+        self.requests.append(dict(params))
+
+        if 'cursorMark' not in params:
+            ids = re.findall(r'"([^"]+)"', params['q'])
+            docs = [i for i in self.docs if i['id'] in ids][:params['rows']]
+
+            return json.dumps({'response': {'docs': docs}})
+
+        start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+        docs = self.docs[start:start + params['rows']]
+        next_cursor = str(start + len(docs)) if docs else params['cursorMark']
+
+        return json.dumps({'response': {'docs': docs}, 'nextCursorMark': next_cursor})
+
+    def update(self, data, headers=None, commit=False):
+        self.updates.append(data)
+
+    def commit(self):
+        pass
+
+    def optimize(self):
+        pass
+
+    def written(self):
+        """
+        Return the fields set by the updates, by document id.
+        """
+        written = {}
+        for data in self.updates:
+            for doc in ET.fromstring(data).findall('./doc'):
+                fields = [(i.get('name'), i.text) for i in doc.findall('./field')]
+                written[fields[0][1]] = dict(fields[1:])
+
+        return written
+
+
+class UnavailableSolr(FakeSolr):
+    """
+    Solr failing the first ``failures`` updates with a transport error, every
+    update by default.
+    """
+
+    def __init__(self, failures=None):
+        super(UnavailableSolr, self).__init__()
+        self.failures = failures
+
+    def update(self, data, headers=None, commit=False):
+        self.updates.append(data)
+
+        if self.failures is None or len(self.updates) <= self.failures:
+            raise IOError('unavailable')
+
+
+class CapturedLogging(object):
+    """
+    Configure logging with the ``LOGGING`` dict of a job, keeping the records
+    that reach its console handler, and restore the previous configuration on
+    exit. Entering it returns the handler, whose ``buffer`` holds the records.
+
+    :param config: ``LOGGING`` dict of the job
+    """
+
+    def __init__(self, config):
+        self.config = copy.deepcopy(config)
+        self.config['handlers'] = {
+            'console': {
+                'level': 'DEBUG',
+                'class': 'logging.handlers.BufferingHandler',
+                'capacity': 10000,
+            }
+        }
+        self.config['loggers']['']['handlers'] = ['console']
+
+    def __enter__(self):
+        root = logging.getLogger()
+        self._handlers = root.handlers[:]
+        self._level = root.level
+        self._disabled = {
+            name: lg.disabled for name, lg in root.manager.loggerDict.items()
+            if isinstance(lg, logging.Logger)
+        }
+
+        logging.config.dictConfig(self.config)
+
+        return root.handlers[0]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        root = logging.getLogger()
+        root.handlers[:] = self._handlers
+        root.setLevel(self._level)
+
+        for name, disabled in self._disabled.items():
+            logging.getLogger(name).disabled = disabled
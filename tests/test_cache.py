@@ -0,0 +1,80 @@
+# coding: utf-8
+import unittest
+import os
+import shutil
+import tempfile
+
+from updatesearch.cache import IndicatorsCache, cached, ACCESSES, CITATIONS
+
+
+class IndicatorsCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'indicators.db')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, value):
+        def func():
+            self.calls.append(value)
+            return value
+        return func
+
+    def test_fetch_once(self):
+        with IndicatorsCache(self.path) as cache:
+            self.assertEqual(cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(10)), 10)
+            self.assertEqual(cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(20)), 10)
+            self.assertEqual(cache.fetch(CITATIONS, 'S0034', 'scl', self.fetch(3)), 3)
+            self.assertEqual(cache.fetch(ACCESSES, 'S0034', 'spa', self.fetch(5)), 5)
+
+        self.assertEqual(self.calls, [10, 3, 5])
+
+    def test_persistence(self):
+        with IndicatorsCache(self.path) as cache:
+            cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(10))
+
+        with IndicatorsCache(self.path) as cache:
+            self.assertEqual(cache.get(ACCESSES, 'S0034', 'scl'), 10)
+
+    def test_expired_entries(self):
+        with IndicatorsCache(self.path, ttl=0) as cache:
+            cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(10))
+            cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(20))
+
+        self.assertEqual(self.calls, [10, 20])
+
+    def test_last_value_of_expired_entry(self):
+        with IndicatorsCache(self.path, ttl=0) as cache:
+            cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(10))
+
+            self.assertIsNone(cache.get(ACCESSES, 'S0034', 'scl'))
+            self.assertEqual(cache.last(ACCESSES, 'S0034', 'scl'), 10)
+            self.assertIsNone(cache.last(CITATIONS, 'S0034', 'scl'))
+
+    def test_refresh(self):
+        with IndicatorsCache(self.path) as cache:
+            cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(10))
+
+        with IndicatorsCache(self.path, refresh=True) as cache:
+            self.assertEqual(cache.fetch(ACCESSES, 'S0034', 'scl', self.fetch(20)), 20)
+
+        with IndicatorsCache(self.path) as cache:
+            self.assertEqual(cache.get(ACCESSES, 'S0034', 'scl'), 20)
+
+    def test_size_eviction(self):
+        with IndicatorsCache(self.path, max_entries=2) as cache:
+            for i in range(5):
+                cache.set(ACCESSES, 'S%d' % i, 'scl', i)
+
+        with IndicatorsCache(self.path) as cache:
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get(ACCESSES, 'S0', 'scl'), None)
+            self.assertEqual(cache.get(ACCESSES, 'S4', 'scl'), 4)
+
+    def test_without_cache(self):
+        self.assertEqual(cached(None, ACCESSES, 'S0034', 'scl', self.fetch(10)), 10)
+        self.assertEqual(cached(None, ACCESSES, 'S0034', 'scl', self.fetch(10)), 10)
+        self.assertEqual(self.calls, [10, 10])
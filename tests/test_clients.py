@@ -0,0 +1,103 @@
+# coding: utf-8
+import sys
+import json
+import unittest
+import threading
+import subprocess
+
+from updatesearch.clients import ClientRegistry
+
+SCRIPTS = [
+    'updatesearch.metadata',
+    'updatepreprint.updatepreprint',
+    'updatesearch.accesses',
+    'updatesearch.citations',
+    'updatesearch.totals',
+]
+
+CLIENT_PACKAGES = ['articlemeta.client', 'citedby.client', 'accessstats.client']
+
+STARTUP = """
+import sys, json, time, importlib
+start = time.time()
+importlib.import_module(%r)
+startup = time.time() - start
+loaded = [i for i in %r if i in sys.modules]
+start = time.time()
+for i in %r:
+    importlib.import_module(i)
+print(json.dumps({'loaded': loaded, 'startup': startup, 'saved': time.time() - start}))
+"""
+
+
+def startup(module):
+    """
+    Import a console script module in a new interpreter, returning the
+    client packages it loaded, its import time and the import time of the
+    client packages it did not load.
+    """
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        STARTUP % (module, CLIENT_PACKAGES, CLIENT_PACKAGES)
+    ])
+
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+class ClientRegistryTests(unittest.TestCase):
+
+    def test_lazy_creation(self):
+        created = []
+        registry = ClientRegistry()
+        registry.register('citedby', lambda: created.append(1) or object())
+
+        self.assertFalse(registry.created('citedby'))
+        self.assertEqual(created, [])
+
+        client = registry.get('citedby')
+
+        self.assertTrue(registry.created('citedby'))
+        self.assertIs(registry.get('citedby'), client)
+        self.assertEqual(created, [1])
+
+    def test_single_client_among_threads(self):
+        registry = ClientRegistry()
+        registry.register('citedby', object)
+        seen = []
+
+        threads = [
+            threading.Thread(target=lambda: seen.append(registry.get('citedby')))
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(id(i) for i in seen)), 1)
+
+    def test_reset(self):
+        registry = ClientRegistry()
+        registry.register('citedby', object)
+        client = registry.get('citedby')
+
+        registry.reset()
+
+        self.assertIsNot(registry.get('citedby'), client)
+
+    def test_unknown_client(self):
+        with self.assertRaises(KeyError):
+            ClientRegistry().get('ratchet')
+
+
+class StartupBenchmarkTests(unittest.TestCase):
+
+    def test_console_scripts_startup(self):
+        for module in SCRIPTS:
+            result = startup(module)
+
+            self.assertEqual(result['loaded'], [], module)
+
+            sys.stderr.write(
+                "\n%s: startup %.1f ms, %.1f ms saved by lazy clients" % (
+                    module, result['startup'] * 1000, result['saved'] * 1000))
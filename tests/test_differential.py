@@ -0,0 +1,72 @@
+# coding: utf-8
+import unittest
+
+from updatesearch.differential import diff, sorted_stream, INCLUDE, UPDATE, REMOVE
+
+
+class SortedStreamTests(unittest.TestCase):
+
+    def test_sort_in_memory(self):
+        items = [('c', '3'), ('a', '1'), ('b', '2')]
+
+        self.assertEqual(
+            list(sorted_stream(items)), [('a', '1'), ('b', '2'), ('c', '3')])
+
+    def test_sort_spilling_to_disk(self):
+        items = [('S%04d-scl' % i, '2020-01-01') for i in range(100, 0, -1)]
+
+        result = list(sorted_stream(items, buffer_size=7))
+
+        self.assertEqual(result, sorted(items))
+
+    def test_prefix_ids_are_sorted_by_id(self):
+        items = [('ab', '1'), ('a', '2')]
+
+        self.assertEqual(list(sorted_stream(items, buffer_size=1)), [('a', '2'), ('ab', '1')])
+
+    def test_repeated_ids_yielded_once(self):
+        items = [('b', '1'), ('a', '1'), ('b', '1'), ('a', '1')]
+
+        self.assertEqual(
+            list(sorted_stream(items, buffer_size=2)), [('a', '1'), ('b', '1')])
+
+
+class DiffTests(unittest.TestCase):
+
+    def test_diff(self):
+        index_items = [('a', '1'), ('b', '1'), ('c', '1'), ('e', '1')]
+        source_items = [('b', '1'), ('c', '2'), ('d', '1'), ('f', '1')]
+
+        result = list(diff(iter(index_items), iter(source_items)))
+
+        self.assertEqual(result, [
+            (REMOVE, 'a', '1'),
+            (UPDATE, 'c', '2'),
+            (INCLUDE, 'd', '1'),
+            (REMOVE, 'e', '1'),
+            (INCLUDE, 'f', '1'),
+        ])
+
+    def test_diff_empty_index(self):
+        result = list(diff(iter([]), iter([('a', '1')])))
+
+        self.assertEqual(result, [(INCLUDE, 'a', '1')])
+
+    def test_diff_unsorted_input(self):
+        with self.assertRaises(ValueError):
+            list(diff(iter([('b', '1'), ('a', '1')]), iter([])))
+
+    def test_diff_duplicate_source_ids(self):
+        index_items = [('S0034-89102010000400007-scl', '1')]
+        source_items = [
+            ('S0034-89102010000400007-scl', '2'),
+            ('S0034-89102010000400007-scl', '2'),
+            ('S0034-89102010000400008-scl', '1'),
+        ]
+
+        result = list(diff(iter(index_items), iter(source_items)))
+
+        self.assertEqual(result, [
+            (UPDATE, 'S0034-89102010000400007-scl', '2'),
+            (INCLUDE, 'S0034-89102010000400008-scl', '1'),
+        ])
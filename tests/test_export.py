@@ -0,0 +1,48 @@
+# coding: utf-8
+import unittest
+
+from datetime import datetime
+
+from updatesearch.export import build_query, export_docs, export_ids
+from tests.fixtures import FakeSolr
+
+
+class BuildQueryTests(unittest.TestCase):
+
+    def test_all_documents(self):
+        self.assertEqual(build_query(), '*:*')
+
+    def test_collection_and_issn(self):
+        self.assertEqual(
+            build_query('scl', '0034-8910'), 'in:scl AND issn:0034-8910')
+
+    def test_from_date(self):
+        self.assertEqual(
+            build_query('scl', from_date=datetime(2020, 5, 12)),
+            'in:scl AND scielo_processing_date:[2020-05-12 TO *]')
+
+
+class ExportTests(unittest.TestCase):
+
+    def test_export_ids_pages_with_cursor_mark(self):
+        solr = FakeSolr({'id': i} for i in ['c', 'a', 'b', 'e', 'd'])
+
+        result = list(export_ids(solr, '*:*', page_size=2))
+
+        self.assertEqual(result, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(solr.requests[0]['cursorMark'], '*')
+        self.assertEqual(solr.requests[0]['sort'], 'id asc')
+        self.assertEqual(len(solr.requests), 4)
+
+    def test_export_docs_is_lazy(self):
+        solr = FakeSolr({'id': i} for i in ['a', 'b', 'c'])
+
+        result = export_docs(solr, '*:*', page_size=1)
+        next(result)
+
+        self.assertEqual(len(solr.requests), 1)
+
+    def test_export_empty_index(self):
+        solr = FakeSolr([])
+
+        self.assertEqual(list(export_ids(solr, '*:*')), [])
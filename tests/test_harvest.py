@@ -0,0 +1,359 @@
+# coding: utf-8
+import os
+import shutil
+import argparse
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+from sickle.oaiexceptions import BadResumptionToken
+
+from updatepreprint.harvest import (
+    HarvestState, pages, split_windows, merge_windows)
+from updatepreprint.updatepreprint import UpdatePreprint
+from updatesearch.writer import BatchWriter
+from tests.fixtures import FakeSolr
+
+
+class Token(object):
+
+    def __init__(self, token):
+        self.token = token
+
+
+class Header(object):
+
+    def __init__(self, identifier, datestamp):
+        self.identifier = identifier
+        self.datestamp = datestamp
+
+
+class Record(object):
+
+    def __init__(self, identifier, datestamp):
+        self.header = Header(identifier, datestamp)
+        self.xml = None
+
+
+class FakeRecords(object):
+    """
+    Records iterator replacing ``resumption_token`` as each page is fetched,
+    like ``sickle.iterator.OAIItemIterator``.
+    """
+
+    def __init__(self, pages):
+        self._pages = pages
+        self._fetch(0)
+
+    def _fetch(self, index):
+        self._index = index
+        self._items = iter(self._pages[index])
+        following = index + 1
+        self.resumption_token = Token(
+            't%d' % following if following < len(self._pages) else '')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                return next(self._items)
+            except StopIteration:
+                if self._index + 1 >= len(self._pages):
+                    raise
+                self._fetch(self._index + 1)
+
+    next = __next__
+
+
+class Identify(object):
+    earliestDatestamp = '2020-04-01T00:00:00Z'
+
+
+class FakeSickle(object):
+
+    def __init__(self, bad_token=False):
+        self.bad_token = bad_token
+        self.calls = []
+
+    def ListRecords(self, **kwargs):
+        self.calls.append(kwargs)
+
+        if self.bad_token and 'resumptionToken' in kwargs:
+            raise BadResumptionToken('expired')
+
+        return FakeRecords([[]])
+
+    def Identify(self):
+        return Identify()
+
+
+class HarvestStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_checkpoint_round_trip(self):
+        state = HarvestState(self.path)
+        state.checkpoint('t1', '2020-04-10T00:00:00Z')
+        state.checkpoint('t2', '2020-04-09T00:00:00Z')
+
+        state = HarvestState(self.path)
+
+        self.assertEqual(state.resumption_token, 't2')
+        self.assertEqual(state.datestamp, '2020-04-10T00:00:00Z')
+        self.assertIsNone(state.last_success)
+
+    def test_finish(self):
+        state = HarvestState(self.path)
+        state.checkpoint('t1', '2020-04-10T00:00:00Z')
+        state.finish()
+
+        state = HarvestState(self.path)
+
+        self.assertIsNone(state.resumption_token)
+        self.assertEqual(state.last_success, '2020-04-10T00:00:00Z')
+
+    def test_finish_with_datestamp(self):
+        state = HarvestState(self.path)
+        state.finish('2020-04-10T00:00:00Z')
+
+        self.assertEqual(
+            HarvestState(self.path).last_success, '2020-04-10T00:00:00Z')
+
+    def test_start_resets_harvest(self):
+        state = HarvestState(self.path)
+        state.start('2020-04-01T00:00:00Z')
+        state.checkpoint('t1', '2020-04-10T00:00:00Z')
+        state.finish()
+        state.start(None, '2020-04-30T00:00:00Z')
+
+        state = HarvestState(self.path)
+
+        self.assertTrue(state.running)
+        self.assertIsNone(state.resumption_token)
+        self.assertIsNone(state.datestamp)
+        self.assertIsNone(state.harvest_from)
+        self.assertEqual(state.harvest_until, '2020-04-30T00:00:00Z')
+        self.assertEqual(state.last_success, '2020-04-10T00:00:00Z')
+
+    def test_missing_file(self):
+        state = HarvestState(self.path)
+
+        self.assertIsNone(state.resumption_token)
+        self.assertIsNone(state.datestamp)
+        self.assertIsNone(state.last_success)
+
+
+class PagesTests(unittest.TestCase):
+
+    def test_token_of_each_page(self):
+        records = FakeRecords([['a', 'b'], ['c'], ['d', 'e']])
+
+        self.assertEqual(list(pages(records)), [
+            ('a', None), ('b', None), ('c', 't1'), ('d', 't2'), ('e', 't2')])
+
+    def test_resumed_first_page(self):
+        records = FakeRecords([['c'], ['d']])
+
+        self.assertEqual(list(pages(records, 't1')), [('c', 't1'), ('d', 't1')])
+
+
+class WindowsTests(unittest.TestCase):
+
+    def test_split_windows(self):
+        windows = split_windows(
+            datetime(2020, 4, 1), datetime(2020, 4, 4), 3)
+
+        self.assertEqual(windows, [
+            ('2020-04-01T00:00:00Z', '2020-04-02T00:00:00Z'),
+            ('2020-04-02T00:00:00Z', '2020-04-03T00:00:00Z'),
+            ('2020-04-03T00:00:00Z', '2020-04-04T00:00:00Z')])
+
+    def test_merge_deduplicates_boundaries(self):
+        records = {
+            1: [Record('a', None), Record('b', None)],
+            2: [Record('b', None), Record('c', None)],
+            3: [],
+        }
+
+        merged = merge_windows(lambda window: records[window], [1, 2, 3])
+
+        self.assertEqual(
+            sorted(i.header.identifier for i in merged), ['a', 'b', 'c'])
+
+    def test_merge_keeps_newer_copy(self):
+        old = Record('a', '2020-04-01T00:00:00Z')
+        new = Record('a', '2020-04-03T00:00:00Z')
+        records = {1: [old, Record('b', '2020-04-01T00:00:00Z')], 2: [new, old]}
+
+        # the first window is harvested before the second one
+        second = threading.Event()
+
+        def harvest(window):
+            if window == 2:
+                second.wait(5)
+            for record in records[window]:
+                yield record
+            second.set()
+
+        merged = list(merge_windows(harvest, [1, 2], depth=1))
+
+        self.assertEqual(
+            [(i.header.identifier, i.header.datestamp) for i in merged], [
+                ('a', '2020-04-01T00:00:00Z'),
+                ('b', '2020-04-01T00:00:00Z'),
+                ('a', '2020-04-03T00:00:00Z')])
+
+    def test_merge_raises_window_error(self):
+
+        def harvest(window):
+            if window == 2:
+                raise IOError('unavailable')
+            return [Record('a', None)]
+
+        with self.assertRaises(IOError):
+            list(merge_windows(harvest, [1, 2]))
+
+    def test_merge_concurrent_windows(self):
+        # each window waits for the others to start, which only happens when
+        # they are harvested concurrently
+        started = threading.Barrier(3, timeout=5)
+
+        def harvest(window):
+            started.wait()
+            return [Record(window, None)]
+
+        merged = merge_windows(harvest, ['a', 'b', 'c'])
+
+        self.assertEqual(
+            sorted(i.header.identifier for i in merged), ['a', 'b', 'c'])
+
+
+class UpdatePreprintHarvestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state = HarvestState(os.path.join(self.dir, 'state.json'))
+        self.up = UpdatePreprint.__new__(UpdatePreprint)
+        self.up.args = argparse.Namespace(
+            resume=False, incremental=False, time=None, until=None, windows=1)
+        self.up.state = self.state
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_from_token(self):
+        self.state.start('2020-04-01T00:00:00Z')
+        self.state.checkpoint('t3', '2020-04-10T00:00:00Z')
+        self.up.args.resume = True
+        sickle = FakeSickle()
+
+        records, token = self.up.list_records(sickle)
+
+        self.assertEqual(token, 't3')
+        self.assertEqual(sickle.calls, [{'resumptionToken': 't3'}])
+
+    def test_resume_expired_token(self):
+        # records are not listed in datestamp order, the whole range of the
+        # interrupted harvest is harvested again
+        self.state.start('2020-04-01T00:00:00Z', '2020-04-30T00:00:00Z')
+        self.state.checkpoint('t3', '2020-04-10T00:00:00Z')
+        self.up.args.resume = True
+        sickle = FakeSickle(bad_token=True)
+
+        records, token = self.up.list_records(sickle)
+
+        self.assertIsNone(token)
+        self.assertEqual(sickle.calls[-1], {
+            'metadataPrefix': 'oai_dc',
+            'from': '2020-04-01T00:00:00Z',
+            'until': '2020-04-30T00:00:00Z'})
+        self.assertIsNone(HarvestState(self.state.path).datestamp)
+
+    def test_resume_full_harvest_after_incremental(self):
+        self.state.start('2020-04-01T00:00:00Z')
+        self.state.checkpoint(None, '2020-04-10T00:00:00Z')
+        self.state.finish()
+        self.state.start()
+        self.state.checkpoint('t3', '2020-04-02T00:00:00Z')
+        self.up.args.resume = True
+        sickle = FakeSickle(bad_token=True)
+
+        self.up.list_records(sickle)
+
+        self.assertEqual(sickle.calls[-1], {'metadataPrefix': 'oai_dc'})
+
+    def test_resume_without_interrupted_harvest(self):
+        self.state.start()
+        self.state.finish('2020-04-10T00:00:00Z')
+        self.up.args.resume = True
+        sickle = FakeSickle()
+
+        self.up.list_records(sickle)
+
+        self.assertEqual(sickle.calls, [{
+            'metadataPrefix': 'oai_dc', 'from': '2020-04-10T00:00:00Z'}])
+
+    def test_incremental(self):
+        self.state.checkpoint('t3', '2020-04-10T00:00:00Z')
+        self.state.finish()
+        self.up.args.incremental = True
+        sickle = FakeSickle()
+
+        self.up.list_records(sickle)
+
+        self.assertEqual(sickle.calls, [{
+            'metadataPrefix': 'oai_dc', 'from': '2020-04-10T00:00:00Z'}])
+
+    def test_checkpoint_after_each_batch(self):
+        self.up._position = None
+        self.up._added = 0
+        items = [
+            (b'<doc/>', Record('a', '2020-04-02T00:00:00Z'), None),
+            (b'<doc/>', Record('b', '2020-04-03T00:00:00Z'), None),
+            (b'<doc/>', Record('c', '2020-04-01T00:00:00Z'), 't1'),
+        ]
+        saved = []
+        checkpoint = self.state.checkpoint
+        self.state.checkpoint = lambda *args: saved.append(args) or checkpoint(*args)
+
+        with BatchWriter(FakeSolr(), 2, on_flush=self.up.checkpoint) as writer:
+            list(self.up.write_stream(writer, items))
+
+        self.assertEqual(saved, [
+            (None, '2020-04-02T00:00:00Z'), ('t1', '2020-04-03T00:00:00Z')])
+        self.assertEqual(self.up._added, writer.total)
+
+    def test_windows_from_earliest_datestamp(self):
+        self.up.args.windows = 2
+        self.up.args.until = '2020-04-03T00:00:00Z'
+
+        self.assertEqual(self.up.windows(FakeSickle()), [
+            ('2020-04-01T00:00:00Z', '2020-04-02T00:00:00Z'),
+            ('2020-04-02T00:00:00Z', '2020-04-03T00:00:00Z')])
+
+    def test_windows_not_checkpointed(self):
+        self.up.args.windows = 2
+        self.up._position = ('t1', '2020-04-03T00:00:00Z')
+
+        self.up.checkpoint(1)
+
+        self.assertIsNone(HarvestState(self.state.path).datestamp)
+
+    def test_pipeline_stream_raises_harvest_errors(self):
+
+        def items():
+            yield Record('a', '2020-04-02T00:00:00Z'), None
+            raise IOError('oai unavailable')
+
+        self.up._pipeline = None
+
+        with self.assertRaises(IOError):
+            list(self.up.pipeline_stream(items()))
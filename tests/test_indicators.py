@@ -0,0 +1,340 @@
+# coding: utf-8
+import unittest
+import os
+import shutil
+import tempfile
+import argparse
+import time
+import threading
+from concurrent.futures import TimeoutError
+from datetime import datetime, timedelta
+
+from updatesearch.export import split_id
+from updatesearch.cache import IndicatorsCache, ACCESSES, CITATIONS
+from updatesearch.workers import CircuitBreaker, CircuitOpenError, RateLimiter
+from updatesearch import indicators
+from updatesearch.indicators import (
+    BackfillQueue, CitationsPrefetcher, Watermark, indexed_documents,
+    lookup_documents, received_citations, guarded)
+from tests.fixtures import FakeSolr
+
+
+class FakeCitedby(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def citedby_pid(self, code, metaonly=False):
+        self.calls.append(code)
+
+        if code == 'empty':
+            return {}
+
+        if code == 'error':
+            raise IOError('unavailable')
+
+        return {'article': {'total_received': len(code)}}
+
+
+class FakeArticle(object):
+
+    def __init__(self, publisher_id):
+        self.publisher_id = publisher_id
+        self.collection_acronym = 'scl'
+
+
+class IndexedDocumentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.solr = FakeSolr([
+            {'id': 'S0034-89102010000400007-scl', 'total_access': 10},
+            {'id': 'S0034-89102010000400008-spa'},
+            {'id': 'preprint_7'},
+        ])
+
+    def test_split_id(self):
+        self.assertEqual(
+            split_id('S0034-89102010000400007-scl'),
+            ('S0034-89102010000400007', 'scl'))
+        self.assertEqual(split_id('preprint_7'), None)
+
+    def test_from_solr(self):
+        result = list(indexed_documents(self.solr, '*:*', 'total_access'))
+
+        self.assertEqual([i[1:3] for i in result], [
+            ('S0034-89102010000400007', 'scl'),
+            ('S0034-89102010000400008', 'spa'),
+        ])
+        self.assertEqual(result[0][3]['total_access'], 10)
+
+    def test_from_identifiers(self):
+        identifiers = [
+            ('S0034-89102010000400008', 'spa'),
+            ('S0034-89102010000400009', 'scl'),
+        ]
+
+        result = list(indexed_documents(
+            self.solr, '*:*', 'total_access', identifiers=identifiers))
+
+        self.assertEqual([i[0] for i in result], ['S0034-89102010000400008-spa'])
+
+    def test_lookup(self):
+        identifiers = [
+            ('S0034-89102010000400009', 'scl'),
+            ('S0034-89102010000400008', 'spa'),
+            ('S0034-89102010000400007', 'scl'),
+        ]
+
+        result = list(lookup_documents(
+            self.solr, '*:*', 'total_access', identifiers, chunk_size=2))
+
+        self.assertEqual([i[0] for i in result], [
+            'S0034-89102010000400008-spa', 'S0034-89102010000400007-scl'])
+        self.assertEqual(result[1][3]['total_access'], 10)
+        self.assertEqual([i['q'] for i in self.solr.requests], [
+            '(*:*) AND id:("S0034-89102010000400009-scl" OR "S0034-89102010000400008-spa")',
+            '(*:*) AND id:("S0034-89102010000400007-scl")'])
+
+
+class ReceivedCitationsTests(unittest.TestCase):
+
+    def test_received_citations(self):
+        self.assertEqual(received_citations(FakeCitedby(), 'S0034'), 5)
+
+    def test_without_citations(self):
+        self.assertEqual(received_citations(FakeCitedby(), 'empty'), 0)
+
+
+class GuardedTests(unittest.TestCase):
+
+    def test_limiter_released_when_abandoned_call_returns(self):
+        limiter = RateLimiter(max_in_flight=1)
+        breaker = CircuitBreaker('citedby', timeout=0.05)
+        hung = threading.Event()
+        finished = threading.Event()
+
+        def call():
+            hung.wait(5)
+            finished.set()
+
+        with self.assertRaises(TimeoutError):
+            guarded(breaker, call, limiter=limiter)
+
+        # the abandoned call still holds its slot
+        self.assertFalse(limiter._in_flight.acquire(blocking=False))
+
+        hung.set()
+        finished.wait(1)
+        time.sleep(0.01)
+
+        self.assertTrue(limiter._in_flight.acquire(blocking=False))
+
+    def test_limiter_released_when_circuit_open(self):
+        limiter = RateLimiter(max_in_flight=1)
+        breaker = CircuitBreaker('citedby', window=1, reset_timeout=60)
+        breaker.failure()
+
+        with self.assertRaises(CircuitOpenError):
+            guarded(breaker, lambda: 1, limiter=limiter)
+
+        self.assertTrue(limiter._in_flight.acquire(blocking=False))
+
+
+class CitationsPrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeCitedby()
+        self.prefetcher = CitationsPrefetcher(concurrency=4)
+        self.prefetcher.clients.get = lambda: self.client
+
+    def test_stream_prefetches_citations(self):
+        articles = [FakeArticle('S%d' % i) for i in range(20)]
+
+        result = list(self.prefetcher.stream(articles))
+
+        self.assertEqual(len(result), 20)
+        self.assertEqual(len(self.client.calls), 20)
+        self.assertEqual(self.prefetcher.pop('S10', 'scl'), 3)
+        self.assertEqual(len(self.client.calls), 20)
+
+    def test_pop_not_prefetched(self):
+        self.assertEqual(self.prefetcher.pop('S0034', 'scl'), 5)
+        self.assertEqual(self.client.calls, ['S0034'])
+
+
+class BackfillQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = BackfillQueue(os.path.join(self.tmpdir, 'backfill.tsv'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_empty(self):
+        self.assertEqual(self.queue.pending([ACCESSES]), [])
+        self.queue.done()
+
+    def test_pending_by_indicator(self):
+        self.queue.add(CITATIONS, 'S1', 'scl')
+        self.queue.add(ACCESSES, 'S2', 'scl')
+        self.queue.add(CITATIONS, 'S1', 'scl')
+        self.queue.add(CITATIONS, 'S3', 'spa')
+
+        self.assertEqual(
+            self.queue.pending([CITATIONS]), [('S1', 'scl'), ('S3', 'spa')])
+        self.queue.done()
+        self.assertEqual(self.queue.pending([CITATIONS]), [])
+        self.assertEqual(
+            self.queue.pending([ACCESSES, CITATIONS]), [('S2', 'scl')])
+
+    def test_pending_kept_until_done(self):
+        self.queue.add(CITATIONS, 'S1', 'scl')
+
+        self.queue.pending([CITATIONS])
+
+        # a new queue, as read by a run started after an interrupted one
+        queue = BackfillQueue(self.queue.path)
+        self.assertEqual(queue.pending([CITATIONS]), [('S1', 'scl')])
+
+    def test_done_keeps_appended_entries(self):
+        self.queue.add(CITATIONS, 'S1', 'scl')
+        self.queue.pending([CITATIONS])
+
+        # appended by another process, and queued again by the backfill run
+        BackfillQueue(self.queue.path).add(CITATIONS, 'S2', 'scl')
+        self.queue.add(CITATIONS, 'S1', 'scl')
+        self.queue.done()
+
+        self.assertEqual(
+            self.queue.pending([CITATIONS]), [('S2', 'scl'), ('S1', 'scl')])
+
+
+class PrefetcherFallbackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = FakeCitedby()
+        self.backfill = BackfillQueue(os.path.join(self.tmpdir, 'backfill.tsv'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def prefetcher(self, **kwargs):
+        prefetcher = CitationsPrefetcher(
+            concurrency=1, backfill=self.backfill, **kwargs)
+        prefetcher.clients.get = lambda: self.client
+
+        return prefetcher
+
+    def test_error_without_cache(self):
+        prefetcher = self.prefetcher()
+
+        list(prefetcher.stream([FakeArticle('error')]))
+
+        self.assertIsNone(prefetcher.pop('error', 'scl'))
+        self.assertEqual(self.client.calls, ['error'])
+        self.assertEqual(self.backfill.pending([CITATIONS]), [('error', 'scl')])
+
+    def test_last_cached_value(self):
+        path = os.path.join(self.tmpdir, 'indicators.db')
+
+        with IndicatorsCache(path, ttl=0) as cache:
+            cache.set(CITATIONS, 'error', 'scl', 7)
+            prefetcher = self.prefetcher(cache=cache)
+
+            self.assertEqual(prefetcher.pop('error', 'scl'), 7)
+
+    def test_open_circuit(self):
+        breaker = CircuitBreaker('citedby', window=1, reset_timeout=60)
+        prefetcher = self.prefetcher(breaker=breaker)
+
+        articles = [FakeArticle('error'), FakeArticle('S1'), FakeArticle('S2')]
+        list(prefetcher.stream(articles))
+
+        self.assertEqual(self.client.calls, ['error'])
+        self.assertIsNone(prefetcher.pop('S2', 'scl'))
+        self.assertEqual(len(self.backfill.pending([CITATIONS])), 3)
+
+
+class WatermarkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'watermark.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_first_run_is_full_sweep(self):
+        self.assertIsNone(Watermark(self.path, ACCESSES).window_start())
+
+    def test_incremental_after_full_sweep(self):
+        watermark = Watermark(self.path, ACCESSES)
+        watermark.save(datetime(2020, 5, 1), full=True)
+        watermark.save(datetime(2020, 5, 10), full=False)
+
+        self.assertEqual(
+            watermark.window_start(30, now=datetime(2020, 5, 11)),
+            datetime(2020, 5, 10))
+        self.assertEqual(watermark.last_full_sweep(), datetime(2020, 5, 1))
+
+    def test_full_sweep_due(self):
+        watermark = Watermark(self.path, ACCESSES)
+        watermark.save(datetime(2020, 5, 1), full=True)
+
+        self.assertIsNone(watermark.window_start(30, now=datetime(2020, 6, 1)))
+
+    def test_jobs_share_file(self):
+        Watermark(self.path, ACCESSES).save(datetime(2020, 5, 1), full=True)
+
+        self.assertIsNone(Watermark(self.path, CITATIONS).last_run())
+        self.assertEqual(
+            Watermark(self.path, ACCESSES).last_run(), datetime(2020, 5, 1))
+
+
+    def test_collection_and_issn_recorded_apart(self):
+        Watermark(self.path, ACCESSES, 'scl').save(datetime(2020, 5, 1), full=True)
+
+        self.assertIsNone(Watermark(self.path, ACCESSES, 'spa').last_run())
+        self.assertIsNone(Watermark(self.path, ACCESSES).last_run())
+        self.assertIsNone(Watermark(self.path, ACCESSES, 'scl', '0034-8910').last_run())
+        self.assertEqual(
+            Watermark(self.path, ACCESSES, 'scl').last_run(), datetime(2020, 5, 1))
+
+    def test_from_arguments_keyed_by_collection(self):
+        args = argparse.Namespace(
+            watermark=self.path, collection='scl', issn=None)
+
+        indicators.watermark_from_arguments(args, ACCESSES).save(
+            datetime(2020, 5, 1), full=True)
+
+        self.assertEqual(
+            Watermark(self.path, ACCESSES, 'scl').last_run(), datetime(2020, 5, 1))
+
+class WindowArgumentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = argparse.ArgumentParser()
+        indicators.add_window_arguments(self.parser)
+
+    def test_every_document(self):
+        args = self.parser.parse_args([])
+
+        self.assertIsNone(indicators.from_date_from_arguments(args))
+
+    def test_period(self):
+        args = self.parser.parse_args(['-p', '2'])
+        from_date = indicators.from_date_from_arguments(args)
+
+        self.assertLess(
+            abs(datetime.now() - timedelta(days=2) - from_date),
+            timedelta(minutes=1))
+
+    def test_from_date_wins_over_watermark(self):
+        args = self.parser.parse_args(['-f', '2020-05-12'])
+        watermark = Watermark('missing.json', ACCESSES)
+
+        self.assertEqual(
+            indicators.from_date_from_arguments(args, watermark),
+            datetime(2020, 5, 12))
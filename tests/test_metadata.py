@@ -0,0 +1,111 @@
+# coding: utf-8
+import unittest
+import json
+import os
+import logging
+
+from xylose.scielodocument import Article
+
+from updatesearch import metadata
+from updatesearch.metadata import UpdateSearch
+from updatesearch.workers import StagedExecutor
+from updatesearch.writer import BatchWriter
+from tests.fixtures import CapturedLogging, FakeSolr, UnavailableSolr
+
+
+class UpdateSearchPipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self._raw_json = json.loads(open(os.path.dirname(__file__)+'/fixtures/article_meta.json').read())
+
+        self._article_meta = Article(self._raw_json)
+
+    def test_pipeline_is_built_once(self):
+        us = UpdateSearch()
+
+        self.assertIs(us.pipeline, us.pipeline)
+
+    def test_pipeline_to_docs(self):
+        us = UpdateSearch()
+
+        docs = us.pipeline_to_docs(self._article_meta)
+
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(
+            docs[0].find('./field[@name="id"]').text, 'S0034-89102010000400007-scl')
+
+    def test_pipeline_stream_skips_invalid_documents(self):
+        us = UpdateSearch()
+
+        articles = [self._article_meta, None, self._article_meta]
+
+        docs = list(us.pipeline_stream(articles))
+
+        self.assertEqual(len(docs), 2)
+
+    def test_pipeline_stream_raises_source_errors(self):
+        us = UpdateSearch()
+
+        def articles():
+            yield self._article_meta
+            raise IOError('articlemeta unavailable')
+
+        docs = us.pipeline_stream(articles())
+
+        self.assertIsNotNone(next(docs))
+        with self.assertRaises(IOError):
+            next(docs)
+
+    def test_transform_stream_with_processes(self):
+        us = UpdateSearch(processes=2)
+
+        articles = [self._article_meta] * 3
+
+        docs = list(us.transform_stream(articles))
+
+        self.assertEqual(len(docs), 3)
+        self.assertTrue(docs[0].startswith(b'<doc>'))
+        self.assertIn(b'S0034-89102010000400007-scl', docs[0])
+
+        # the journal cache stats of the worker processes are aggregated
+        sequential = UpdateSearch()
+        list(sequential.pipeline_stream(articles))
+        self.assertEqual(
+            us.journal_cache.hits + us.journal_cache.misses,
+            sequential.journal_cache.hits + sequential.journal_cache.misses)
+        self.assertGreater(us.journal_cache.misses, 0)
+
+
+class LoggingTests(unittest.TestCase):
+
+    def test_writer_errors_logged(self):
+        with CapturedLogging(metadata.LOGGING) as handler:
+            with BatchWriter(UnavailableSolr(), retries=0) as writer:
+                writer.add(b'<doc/>')
+
+        self.assertIn(
+            ('updatesearch.writer', logging.ERROR),
+            [(i.name, i.levelno) for i in handler.buffer])
+
+    def test_delete_rate_logged(self):
+        with CapturedLogging(metadata.LOGGING) as handler:
+            with BatchWriter(FakeSolr()) as writer:
+                writer.delete('S0034-89102010000400007-scl')
+
+        self.assertTrue([
+            i for i in handler.buffer if i.name == 'updatesearch.writer' and
+            i.getMessage().startswith('Removed (1) documents')])
+
+    def test_stage_stats_logged(self):
+        executor = StagedExecutor([
+            ('fetch', lambda items: items),
+            ('write', lambda items: items),
+        ])
+
+        with CapturedLogging(metadata.LOGGING) as handler:
+            executor.run(range(3))
+
+        self.assertEqual(
+            [i.getMessage().split(':')[0] for i in handler.buffer
+             if i.name == 'updatesearch.workers'],
+            ['Stage fetch', 'Stage write'])
@@ -1,6 +1,9 @@
 # coding: utf-8
+import sys
+import timeit
 import unittest
 from lxml import etree as ET
+from langcodes import standardize_tag
 
 from updatepreprint import pipeline_xml
 
@@ -466,3 +469,114 @@ class TestPermission(unittest.TestCase):
             xml.find(".//field[@name='use_license_uri']").text,
             "https://creativecommons.org/licenses/by/4.0"
         )
+
+
+class TestDCRecord(unittest.TestCase):
+
+    text = """<record xmlns="http://www.openarchives.org/OAI/2.0/">
+    <header>
+        <identifier>oai:ojs.preprints.scielo.org:preprint/7</identifier>
+    </header>
+    <metadata>
+        <oai_dc:dc
+            xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+            xmlns:dc="http://purl.org/dc/elements/1.1/">
+            <dc:title xml:lang="pt-BR">Titulo</dc:title>
+            <dc:creator>Trentin,Robson Gonçalves</dc:creator>
+            <dc:subject xml:lang="en-US">water</dc:subject>
+            <dc:description xml:lang="en-US">Abstract</dc:description>
+            <dc:date>2020-04-09</dc:date>
+            <dc:identifier>https://preprints.scielo.org/index.php/scielo/preprint/view/7</dc:identifier>
+            <dc:identifier>10.1590/scielopreprints.7</dc:identifier>
+            <dc:language>pt</dc:language>
+            <dc:rights>https://creativecommons.org/licenses/by/4.0</dc:rights>
+        </oai_dc:dc>
+    </metadata>
+    </record>
+    """
+
+    def test_single_walk_structure(self):
+        record = pipeline_xml.DCRecord(ET.fromstring(self.text))
+
+        self.assertEqual(record.identifiers, [
+            'https://preprints.scielo.org/index.php/scielo/preprint/view/7',
+            '10.1590/scielopreprints.7'])
+        self.assertEqual(record.languages, ['pt'])
+        self.assertEqual(record.titles, [('Titulo', 'pt-BR')])
+        self.assertEqual(record.subjects, [('water', 'en-US')])
+        self.assertEqual(record.descriptions, [('Abstract', 'en-US')])
+        self.assertEqual(record.creators, ['Trentin,Robson Gonçalves'])
+        self.assertEqual(record.rights, ['https://creativecommons.org/licenses/by/4.0'])
+        self.assertEqual(record.dates, ['2020-04-09'])
+
+    def test_setup_document(self):
+        raw, xml = pipeline_xml.SetupDocument().transform(ET.fromstring(self.text))
+
+        self.assertIsInstance(raw, pipeline_xml.DCRecord)
+        self.assertIs(pipeline_xml.dc_record(raw), raw)
+
+        raw, xml = pipeline_xml.Fulltexts().transform((raw, xml))
+
+        self.assertEqual(
+            xml.find(".//field[@name='fulltext_html_pt']").text,
+            'https://preprints.scielo.org/index.php/scielo/preprint/view/7')
+
+
+class TestNormalizeLang(unittest.TestCase):
+
+    def test_variants(self):
+        self.assertEqual(pipeline_xml.normalize_lang('pt-BR'), 'pt-BR')
+        self.assertEqual(
+            pipeline_xml.normalize_lang('pt-BR', pipeline_xml.PRIMARY_SUBTAG), 'pt')
+        self.assertEqual(
+            pipeline_xml.normalize_lang('es-ES', pipeline_xml.TWO_LETTERS), 'es')
+        self.assertEqual(
+            pipeline_xml.normalize_lang('en', pipeline_xml.PRIMARY_SUBTAG), 'en')
+
+    def test_memoized(self):
+        pipeline_xml.normalize_lang.cache_clear()
+
+        for i in range(10):
+            pipeline_xml.normalize_lang('en-US', pipeline_xml.PRIMARY_SUBTAG)
+
+        info = pipeline_xml.normalize_lang.cache_info()
+
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 9)
+        self.assertEqual(info.maxsize, pipeline_xml.LANG_CACHE_SIZE)
+
+    def test_benchmark_per_record(self):
+        # language tags normalized for a record with two languages, two
+        # identifiers, two abstracts and four keywords
+        calls = [
+            ('pt', pipeline_xml.FULL_TAG), ('en', pipeline_xml.FULL_TAG),
+            ('pt', pipeline_xml.FULL_TAG), ('en', pipeline_xml.FULL_TAG),
+            ('pt-BR', pipeline_xml.PRIMARY_SUBTAG), ('en-US', pipeline_xml.PRIMARY_SUBTAG),
+            ('pt-BR', pipeline_xml.PRIMARY_SUBTAG), ('en-US', pipeline_xml.PRIMARY_SUBTAG),
+            ('pt-BR', pipeline_xml.TWO_LETTERS), ('pt-BR', pipeline_xml.TWO_LETTERS),
+            ('en-US', pipeline_xml.TWO_LETTERS), ('en-US', pipeline_xml.TWO_LETTERS),
+        ]
+        variants = {
+            pipeline_xml.FULL_TAG: lambda tag: tag,
+            pipeline_xml.PRIMARY_SUBTAG: lambda tag: tag.split('-')[0],
+            pipeline_xml.TWO_LETTERS: lambda tag: tag[0:2],
+        }
+
+        def unmemoized():
+            for tag, variant in calls:
+                standardize_tag(variants[variant](tag))
+
+        def memoized():
+            for tag, variant in calls:
+                pipeline_xml.normalize_lang(tag, variant)
+
+        records = 2000
+        before = min(timeit.repeat(unmemoized, number=records, repeat=3))
+        after = min(timeit.repeat(memoized, number=records, repeat=3))
+
+        sys.stderr.write(
+            "\nLanguage tags: %.1f us per record unmemoized, %.1f us memoized, %.1f us saved" % (
+                before / records * 1e6, after / records * 1e6,
+                (before - after) / records * 1e6))
+
+        self.assertLess(after, before)
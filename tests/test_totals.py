@@ -0,0 +1,269 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import logging
+import unittest
+from unittest import mock
+
+from updatesearch.cache import ACCESSES, CITATIONS
+from updatesearch import totals
+from updatesearch.totals import UpdateSearch
+from updatesearch import accesses, citations
+from updatesearch.workers import ThreadLocalClient
+from updatesearch.indicators import BackfillQueue
+from updatesearch.writer import BatchWriter
+from tests.fixtures import CapturedLogging, FakeSolr, UnavailableSolr
+
+
+class FakeAccessStats(object):
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def document(self, publisher_id, collection):
+        return {'access_total': {'value': self.totals[publisher_id]}}
+
+
+class FakeCitedby(object):
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def citedby_pid(self, publisher_id, metaonly=False):
+        return {'article': {'total_received': self.totals[publisher_id]}}
+
+
+PIDS = [
+    'S0034-89102010000400001',
+    'S0034-89102010000400002',
+    'S0034-89102010000400003',
+    'S0034-89102010000400004',
+]
+
+
+class UpdateSearchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.us = UpdateSearch()
+
+    def test_set_indicators(self):
+        doc = self.us.set_indicators(
+            'S0034-89102010000400007-scl',
+            {'total_access': 10, 'total_received': 2})
+
+        fields = doc.findall('./field')
+
+        self.assertEqual(
+            [(i.get('name'), i.text, i.get('update')) for i in fields],
+            [('id', 'S0034-89102010000400007-scl', None),
+             ('total_access', '10', 'set'),
+             ('total_received', '2', 'set')])
+
+    def test_tasks_one_per_indicator(self):
+        items = [('a-scl', 'a', 'scl', {}), ('b-scl', 'b', 'scl', {})]
+
+        tasks = list(self.us.tasks(items))
+
+        self.assertEqual(
+            [(indicator, item[0]) for indicator, item in tasks],
+            [(ACCESSES, 'a-scl'), (CITATIONS, 'a-scl'),
+             (ACCESSES, 'b-scl'), (CITATIONS, 'b-scl')])
+
+    def test_fetch_failure(self):
+
+        def request(indicator, publisher_id, collection):
+            raise IOError('unavailable')
+
+        self.us.request = request
+
+        result = self.us.fetch((ACCESSES, ('a-scl', 'a', 'scl', {})))
+
+        self.assertEqual(result, (ACCESSES, 'a-scl', {}, None))
+
+    def test_changes_join_indicators(self):
+        doc = {'id': 'a-scl', 'total_access': 10, 'total_received': 2}
+        results = [
+            (CITATIONS, 'a-scl', doc, 3),
+            (ACCESSES, 'b-scl', {'id': 'b-scl'}, 1),
+            (ACCESSES, 'a-scl', doc, 10),
+            (CITATIONS, 'b-scl', {'id': 'b-scl'}, None),
+        ]
+
+        changes = list(self.us.changes(results))
+
+        self.assertEqual(changes, [
+            ('a-scl', {'total_received': 3}),
+            ('b-scl', {'total_access': 1}),
+        ])
+
+    def test_changes_unchanged(self):
+        doc = {'id': 'a-scl', 'total_access': 10, 'total_received': 2}
+        results = [(ACCESSES, 'a-scl', doc, 10), (CITATIONS, 'a-scl', doc, 2)]
+
+        self.assertEqual(list(self.us.changes(results)), [('a-scl', {})])
+
+
+class SingleIndicatorTests(unittest.TestCase):
+
+    def test_accesses_job(self):
+        us = accesses.UpdateSearch()
+        items = [('a-scl', 'a', 'scl', {'id': 'a-scl', 'total_access': 1})]
+
+        tasks = list(us.tasks(items))
+        changes = list(us.changes([(ACCESSES, 'a-scl', items[0][3], 2)]))
+
+        self.assertEqual([i for i, item in tasks], [ACCESSES])
+        self.assertEqual(changes, [('a-scl', {'total_access': 2})])
+
+    def test_citations_job(self):
+        us = citations.UpdateSearch()
+        items = [('a-scl', 'a', 'scl', {'id': 'a-scl'})]
+
+        tasks = list(us.tasks(items))
+
+        self.assertEqual([i for i, item in tasks], [CITATIONS])
+        self.assertEqual(us.fields, {CITATIONS: 'total_received'})
+
+
+class RunTests(unittest.TestCase):
+    """
+    Jobs run over an unchanged count, a changed count, a missing field and a
+    zero count.
+    """
+
+    def solr(self, field):
+        return FakeSolr([
+            {'id': PIDS[0] + '-scl', field: 10},
+            {'id': PIDS[1] + '-scl', field: 5},
+            {'id': PIDS[2] + '-scl'},
+            {'id': PIDS[3] + '-scl', field: 0},
+        ])
+
+    def upstream(self):
+        return dict(zip(PIDS, [10, 7, 0, 0]))
+
+    def test_accesses_only_changed_written(self):
+        us = accesses.UpdateSearch()
+        us.solr = self.solr('total_access')
+        us.clients[ACCESSES] = ThreadLocalClient(
+            lambda: FakeAccessStats(self.upstream()))
+
+        with self.assertLogs('updatesearch.totals', 'INFO') as logs:
+            us.run()
+
+        self.assertIn(
+            'Changed (2) and unchanged (2) documents, 50.0% changed.',
+            '\n'.join(logs.output))
+        self.assertEqual(us.solr.written(), {
+            PIDS[1] + '-scl': {'total_access': '7'},
+            PIDS[2] + '-scl': {'total_access': '0'},
+        })
+
+    def test_citations_only_changed_written(self):
+        us = citations.UpdateSearch(workers=2)
+        us.solr = self.solr('total_received')
+        us.clients[CITATIONS] = ThreadLocalClient(
+            lambda: FakeCitedby(self.upstream()))
+
+        us.run()
+
+        self.assertEqual(us.solr.written(), {
+            PIDS[1] + '-scl': {'total_received': '7'},
+            PIDS[2] + '-scl': {'total_received': '0'},
+        })
+
+    def test_unchanged_nothing_written(self):
+        us = accesses.UpdateSearch()
+        us.solr = FakeSolr([{'id': PIDS[0] + '-scl', 'total_access': 10}])
+        us.clients[ACCESSES] = ThreadLocalClient(
+            lambda: FakeAccessStats(self.upstream()))
+
+        us.run()
+
+        self.assertEqual(us.solr.updates, [])
+
+    def test_failures_not_complete(self):
+        us = accesses.UpdateSearch()
+        us.solr = self.solr('total_access')
+        us.clients[ACCESSES] = ThreadLocalClient(lambda: FakeAccessStats({}))
+
+        us.run()
+
+        self.assertEqual(us.failures, 4)
+        self.assertFalse(us.complete())
+        self.assertEqual(us.solr.updates, [])
+
+    def test_failures_queued_for_backfill_complete(self):
+        us = accesses.UpdateSearch(backfill=BackfillQueue(os.devnull))
+        us.solr = self.solr('total_access')
+        us.clients[ACCESSES] = ThreadLocalClient(lambda: FakeAccessStats({}))
+
+        us.run()
+
+        self.assertTrue(us.complete())
+
+    def test_dropped_updates_not_complete(self):
+        us = accesses.UpdateSearch(backfill=BackfillQueue(os.devnull))
+        us.solr = self.solr('total_access')
+        us.solr.update = mock.Mock(side_effect=IOError('unavailable'))
+        us.clients[ACCESSES] = ThreadLocalClient(
+            lambda: FakeAccessStats(self.upstream()))
+
+        with mock.patch('updatesearch.writer.time.sleep'):
+            us.run()
+
+        self.assertEqual(us.dropped, 2)
+        self.assertFalse(us.complete())
+
+
+
+class BackfillRunTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backfill = BackfillQueue(os.path.join(self.tmpdir, 'backfill.tsv'))
+        self.backfill.add(ACCESSES, PIDS[1], 'scl')
+        self.backfill.add(ACCESSES, PIDS[2], 'scl')
+        self.us = accesses.UpdateSearch(source='backfill', backfill=self.backfill)
+        self.us.solr = FakeSolr([
+            {'id': PIDS[0] + '-scl', 'total_access': 10},
+            {'id': PIDS[1] + '-scl', 'total_access': 5},
+            {'id': PIDS[2] + '-scl', 'total_access': 3},
+        ])
+        self.us.clients[ACCESSES] = ThreadLocalClient(
+            lambda: FakeAccessStats(dict(zip(PIDS, [1, 7, 8]))))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_queued_documents_loaded_and_removed(self):
+        self.us.run()
+
+        self.assertEqual(self.us.solr.written(), {
+            PIDS[1] + '-scl': {'total_access': '7'},
+            PIDS[2] + '-scl': {'total_access': '8'},
+        })
+        self.assertEqual(self.backfill.pending([ACCESSES]), [])
+
+    def test_queued_documents_kept_when_dropped(self):
+        self.us.solr.update = mock.Mock(side_effect=IOError('unavailable'))
+
+        with mock.patch('updatesearch.writer.time.sleep'):
+            self.us.run()
+
+        self.assertEqual(
+            BackfillQueue(self.backfill.path).pending([ACCESSES]),
+            [(PIDS[1], 'scl'), (PIDS[2], 'scl')])
+
+
+class LoggingTests(unittest.TestCase):
+
+    def test_writer_errors_logged(self):
+        with CapturedLogging(totals.LOGGING) as handler:
+            with BatchWriter(UnavailableSolr(), retries=0) as writer:
+                writer.add(b'<doc/>')
+
+        self.assertIn(
+            ('updatesearch.writer', logging.ERROR),
+            [(i.name, i.levelno) for i in handler.buffer])
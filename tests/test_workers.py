@@ -0,0 +1,280 @@
+# coding: utf-8
+import unittest
+import threading
+import time
+
+from concurrent.futures import TimeoutError
+
+from updatesearch.workers import (
+    ThreadLocalClient, StagedExecutor, RateLimiter, CircuitBreaker,
+    CircuitOpenError, imap_unordered, process_context)
+
+
+class ThreadLocalClientTests(unittest.TestCase):
+
+    def test_one_client_per_thread(self):
+        clients = ThreadLocalClient(object)
+        seen = []
+
+        def worker():
+            seen.append(clients.get())
+            seen.append(clients.get())
+
+        threads = [threading.Thread(target=worker) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(seen[0], seen[1])
+        self.assertIs(seen[2], seen[3])
+        self.assertIsNot(seen[0], seen[2])
+
+
+class ImapUnorderedTests(unittest.TestCase):
+
+    def test_sequential(self):
+        result = list(imap_unordered(lambda x: x * 2, range(5)))
+
+        self.assertEqual(result, [0, 2, 4, 6, 8])
+
+    def test_concurrent(self):
+        result = imap_unordered(lambda x: x * 2, range(50), workers=4)
+
+        self.assertEqual(sorted(result), [i * 2 for i in range(50)])
+
+    def test_order_of_completion(self):
+
+        def func(x):
+            time.sleep(0.2 if x == 0 else 0)
+            return x
+
+        result = list(imap_unordered(func, range(3), workers=3))
+
+        self.assertEqual(result[-1], 0)
+
+    def test_backpressure(self):
+        consumed = []
+
+        def items():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        result = imap_unordered(lambda x: x, items(), workers=2, max_pending=4)
+        next(result)
+
+        self.assertLessEqual(len(consumed), 8)
+        result.close()
+
+    def test_processes_not_forked_with_threads(self):
+        self.assertNotEqual(process_context().get_start_method(), 'fork')
+
+        # the pool is created while a lock of this process is held
+        held = threading.Lock()
+        held.acquire()
+        try:
+            result = imap_unordered(abs, range(-5, 0), workers=2, processes=True)
+
+            self.assertEqual(sorted(result), [1, 2, 3, 4, 5])
+        finally:
+            held.release()
+
+
+class StagedExecutorTests(unittest.TestCase):
+
+    def test_run_stages(self):
+        written = []
+
+        def double(items):
+            for item in items:
+                yield item * 2
+
+        def write(items):
+            for item in items:
+                written.append(item)
+                yield item
+
+        executor = StagedExecutor([
+            ('fetch', iter),
+            ('transform', double),
+            ('write', write)
+        ], depth=2)
+        executor.run(range(10))
+
+        self.assertEqual(written, [i * 2 for i in range(10)])
+        self.assertEqual([i.items for i in executor.stats], [10, 10, 10])
+
+    def test_busy_and_idle_time(self):
+
+        def slow(items):
+            for item in items:
+                time.sleep(0.01)
+                yield item
+
+        executor = StagedExecutor([
+            ('fetch', iter),
+            ('transform', slow),
+            ('write', iter)
+        ])
+        executor.run(range(10))
+
+        fetch, transform, write = executor.stats
+
+        self.assertGreater(transform.busy, write.busy)
+        self.assertGreater(write.idle, transform.idle)
+
+    def test_errors_are_raised(self):
+
+        def fail(items):
+            for item in items:
+                raise ValueError(item)
+            yield
+
+        executor = StagedExecutor([
+            ('fetch', iter),
+            ('transform', fail),
+            ('write', iter)
+        ], depth=1)
+
+        with self.assertRaises(ValueError):
+            executor.run(range(1000))
+
+
+class RateLimiterTests(unittest.TestCase):
+
+    def test_no_limit(self):
+        limiter = RateLimiter()
+
+        start = time.time()
+        for i in range(1000):
+            with limiter:
+                pass
+
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+
+        start = time.time()
+        for i in range(11):
+            with limiter:
+                pass
+
+        self.assertGreaterEqual(time.time() - start, 0.18)
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=1, burst=5)
+
+        start = time.time()
+        for i in range(5):
+            with limiter:
+                pass
+
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_max_in_flight(self):
+        limiter = RateLimiter(max_in_flight=2)
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def request(x):
+            with limiter:
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+            return x
+
+        list(imap_unordered(request, range(20), workers=6))
+
+        self.assertEqual(peak[0], 2)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def fail(self):
+        raise IOError('unavailable')
+
+    def test_closed(self):
+        breaker = CircuitBreaker('citedby', window=4)
+
+        self.assertEqual(breaker.call(lambda x: x * 2, 2), 4)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_on_error_rate(self):
+        breaker = CircuitBreaker('citedby', threshold=0.5, window=4)
+
+        for func in [self.fail, lambda: 1, self.fail]:
+            try:
+                breaker.call(func)
+            except IOError:
+                pass
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        with self.assertRaises(IOError):
+            breaker.call(self.fail)
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: 1)
+
+        self.assertEqual(breaker.rejected, 1)
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker('citedby', window=1, reset_timeout=0.05)
+
+        with self.assertRaises(IOError):
+            breaker.call(self.fail)
+
+        time.sleep(0.06)
+
+        with self.assertRaises(IOError):
+            breaker.call(self.fail)
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+
+        self.assertEqual(breaker.call(lambda: 1), 1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_single_probe(self):
+        breaker = CircuitBreaker('citedby', window=1, reset_timeout=0)
+
+        with self.assertRaises(IOError):
+            breaker.call(self.fail)
+
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_timeout(self):
+        breaker = CircuitBreaker('citedby', timeout=0.05, window=1)
+
+        with self.assertRaises(TimeoutError):
+            breaker.call(time.sleep, 0.5)
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_concurrent_calls_not_queued(self):
+        breaker = CircuitBreaker('citedby', timeout=0.3, concurrency=2)
+        started = threading.Barrier(2, timeout=1)
+        results = []
+
+        def call():
+            results.append(breaker.call(started.wait))
+
+        threads = [threading.Thread(target=call) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [0, 1])
+
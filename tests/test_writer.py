@@ -0,0 +1,250 @@
+# coding: utf-8
+import unittest
+import time
+
+from lxml import etree as ET
+
+from updatesearch.writer import BatchWriter, rejected
+from tests.fixtures import FakeSolr, UnavailableSolr
+
+
+REJECTED = (
+    '<response><lst name="responseHeader"><int name="status">400</int></lst>'
+    '<lst name="error"><str name="msg">ERROR: bad document</str></lst></response>')
+
+
+class RejectingSolr(FakeSolr):
+    """
+    Solr rejecting the requests with the ``bad`` document or id.
+    """
+
+    def update(self, data, headers=None, commit=False):
+        self.updates.append(data)
+
+        if b'bad' in data:
+            return REJECTED
+
+        return '{"responseHeader":{"status":0,"QTime":1}}'
+
+
+def make_doc(identifier):
+    doc = ET.Element('doc')
+    field = ET.Element('field')
+    field.set('name', 'id')
+    field.text = identifier
+    doc.append(field)
+
+    return doc
+
+
+class BatchWriterTests(unittest.TestCase):
+
+    def test_flush_by_batch_size(self):
+        solr = FakeSolr()
+        writer = BatchWriter(solr, batch_size=2)
+
+        for i in range(5):
+            writer.add(make_doc(str(i)))
+
+        self.assertEqual(len(solr.updates), 2)
+        self.assertEqual(len(writer), 1)
+
+        writer.close()
+
+        self.assertEqual(len(solr.updates), 3)
+        self.assertEqual(writer.total, 5)
+
+    def test_flush_by_batch_bytes(self):
+        solr = FakeSolr()
+        doc = ET.tostring(make_doc('S0102-695X2015000100053-scl'))
+        writer = BatchWriter(solr, batch_size=100, batch_bytes=len(doc) * 2)
+
+        for i in range(3):
+            writer.add(doc)
+
+        self.assertEqual(len(solr.updates), 1)
+        self.assertEqual(len(writer), 1)
+
+    def test_single_add_envelope(self):
+        solr = FakeSolr()
+
+        with BatchWriter(solr) as writer:
+            writer.add(make_doc('1'))
+            writer.add(make_doc('2'))
+
+        xml = ET.fromstring(solr.updates[0])
+
+        self.assertEqual(xml.tag, 'add')
+        self.assertEqual(
+            [i.text for i in xml.findall('./doc/field[@name="id"]')], ['1', '2'])
+
+    def test_flush_on_interrupt(self):
+        solr = FakeSolr()
+
+        with self.assertRaises(KeyboardInterrupt):
+            with BatchWriter(solr) as writer:
+                writer.add(make_doc('1'))
+                raise KeyboardInterrupt()
+
+        self.assertEqual(len(solr.updates), 1)
+
+    def test_delete_by_id_batch(self):
+        solr = FakeSolr()
+
+        with BatchWriter(solr, batch_size=2) as writer:
+            for i in range(3):
+                writer.delete('S0034-8910201000040000%d-scl' % i)
+
+            self.assertEqual(len(solr.updates), 1)
+
+        self.assertEqual(len(solr.updates), 2)
+        self.assertEqual(writer.deleted, 3)
+
+        xml = ET.fromstring(solr.updates[0])
+
+        self.assertEqual(xml.tag, 'delete')
+        self.assertEqual(
+            [i.text for i in xml.findall('./id')],
+            ['S0034-89102010000400000-scl', 'S0034-89102010000400001-scl'])
+
+    def test_commit_within(self):
+        solr = FakeSolr()
+
+        with BatchWriter(solr, commit_within=10000) as writer:
+            writer.add(make_doc('preprint_1'))
+
+        xml = ET.fromstring(solr.updates[0])
+
+        self.assertEqual(xml.get('commitWithin'), '10000')
+        self.assertEqual(len(xml.findall('./doc')), 1)
+
+    def test_on_flush(self):
+        solr = FakeSolr()
+        flushed = []
+
+        with BatchWriter(solr, batch_size=2, on_flush=flushed.append) as writer:
+            for i in range(3):
+                writer.add(make_doc(str(i)))
+
+            self.assertEqual(flushed, [2])
+
+        self.assertEqual(flushed, [2, 1])
+
+    def test_on_flush_not_called_on_failure(self):
+
+        class FailingSolr(object):
+            def update(self, data, headers=None, commit=False):
+                raise IOError('unavailable')
+
+        flushed = []
+
+        with BatchWriter(FailingSolr(), on_flush=flushed.append, retries=0) as writer:
+            writer.add(make_doc('1'))
+
+        self.assertEqual(flushed, [])
+
+    def test_rejected_batch_bisected(self):
+        solr = RejectingSolr()
+
+        with BatchWriter(solr, batch_size=8) as writer:
+            for i in range(8):
+                writer.add(make_doc('bad' if i == 5 else str(i)))
+
+        self.assertEqual(writer.total, 7)
+        self.assertEqual(writer.dropped, 1)
+        accepted = [i for i in solr.updates if b'bad' not in i]
+        self.assertEqual(
+            sorted(i.text for u in accepted
+                   for i in ET.fromstring(u).findall('./doc/field')),
+            ['0', '1', '2', '3', '4', '6', '7'])
+
+    def test_rejected_ids_bisected(self):
+        solr = RejectingSolr()
+
+        with BatchWriter(solr, batch_size=4) as writer:
+            for i in ['1', 'bad', '3', '4']:
+                writer.delete(i)
+
+        self.assertEqual(writer.deleted, 3)
+
+    def test_transport_error_retried_not_bisected(self):
+        solr = UnavailableSolr()
+
+        with BatchWriter(solr, batch_size=4, retries=2, backoff=0) as writer:
+            for i in range(4):
+                writer.add(make_doc(str(i)))
+
+        self.assertEqual(len(solr.updates), 3)
+        self.assertEqual(len(set(solr.updates)), 1)
+        self.assertEqual(writer.total, 0)
+        self.assertEqual(writer.dropped, 4)
+
+    def test_transport_error_recovered(self):
+        solr = UnavailableSolr(failures=2)
+
+        with BatchWriter(solr, batch_size=4, retries=2, backoff=0) as writer:
+            for i in range(4):
+                writer.add(make_doc(str(i)))
+
+        self.assertEqual(writer.total, 4)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_rejected_response(self):
+        self.assertTrue(rejected(REJECTED))
+        self.assertTrue(rejected('{"responseHeader":{"status":400},"error":{"msg":"x"}}'))
+        self.assertFalse(rejected('{"responseHeader":{"status":0,"QTime":1}}'))
+        self.assertFalse(rejected(
+            '<response><lst name="responseHeader"><int name="status">0</int></lst></response>'))
+        self.assertFalse(rejected(None))
+
+    def test_flush_by_interval(self):
+        solr = FakeSolr()
+        writer = BatchWriter(solr, batch_size=100, flush_interval=0.05)
+
+        writer.add(make_doc('1'))
+        self.assertEqual(len(solr.updates), 0)
+
+        time.sleep(0.06)
+        writer.add(make_doc('2'))
+
+        self.assertEqual(len(solr.updates), 1)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_expired(self):
+        solr = FakeSolr()
+        writer = BatchWriter(solr, batch_size=100, flush_interval=0.05)
+
+        writer.add(make_doc('1'))
+        writer.flush_expired()
+        self.assertEqual(len(solr.updates), 0)
+
+        time.sleep(0.06)
+        writer.flush_expired()
+
+        self.assertEqual(len(solr.updates), 1)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_expired_empty_buffer(self):
+        solr = FakeSolr()
+        writer = BatchWriter(solr, flush_interval=0.01)
+
+        time.sleep(0.02)
+        writer.flush_expired()
+
+        self.assertEqual(solr.updates, [])
+
+    def test_atomic_updates_in_single_add(self):
+        solr = FakeSolr()
+        doc = make_doc('S0034-89102010000400007-scl')
+        field = ET.SubElement(doc, 'field', name='total_access', update='set')
+        field.text = '10'
+
+        with BatchWriter(solr) as writer:
+            writer.add(doc)
+            writer.add(make_doc('S0034-89102010000400008-scl'))
+
+        xml = ET.fromstring(solr.updates[0])
+
+        self.assertEqual(len(xml.findall('./doc')), 2)
+        self.assertEqual(
+            xml.find('./doc/field[@name="total_access"]').get('update'), 'set')
@@ -985,4 +985,101 @@ class ExportTests(unittest.TestCase):
         except AttributeError:
             self.assertTrue(True)
         else:
-            self.assertTrue(False)
\ No newline at end of file
+            self.assertTrue(False)
+
+class JournalCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self._raw_json = json.loads(open(os.path.dirname(__file__)+'/fixtures/article_meta.json').read())
+
+        self._article_meta = Article(self._raw_json)
+
+    def test_journal_fields_are_built_once(self):
+        cache = pipeline_xml.JournalCache()
+        xmlarticle = pipeline_xml.JournalTitle(cache)
+
+        for i in range(3):
+            raw, xml = xmlarticle.transform([self._article_meta, ET.Element('doc')])
+
+        self.assertEqual(u'Revista de Saúde Pública', xml.find('./field[@name="journal_title"]').text)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+    def test_journal_fields_are_cloned(self):
+        cache = pipeline_xml.JournalCache()
+        xmlarticle = pipeline_xml.JournalAbbrevTitle(cache)
+
+        raw, xml1 = xmlarticle.transform([self._article_meta, ET.Element('doc')])
+        raw, xml2 = xmlarticle.transform([self._article_meta, ET.Element('doc')])
+
+        self.assertEqual(len(xml1.findall('./field[@name="ta"]')), 1)
+        self.assertEqual(len(xml2.findall('./field[@name="ta"]')), 1)
+
+    def test_journal_cache_eviction(self):
+        cache = pipeline_xml.JournalCache(maxsize=1)
+        xmlarticle = pipeline_xml.JournalTitle(cache)
+        other = Article(json.loads(json.dumps(self._raw_json)))
+        other.data['title']['v400'] = [{'_': '0000-0000'}]
+
+        xmlarticle.transform([self._article_meta, ET.Element('doc')])
+        xmlarticle.transform([other, ET.Element('doc')])
+        xmlarticle.transform([self._article_meta, ET.Element('doc')])
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.misses, 3)
+
+
+    def test_journal_cache_keyed_by_collection(self):
+        cache = pipeline_xml.JournalCache()
+        xmlarticle = pipeline_xml.JournalTitle(cache)
+        other = Article(json.loads(json.dumps(self._raw_json)))
+        other.data['collection'] = 'spa'
+        other.data['title']['v100'] = [{'_': 'Revista de Saude Publica (spa)'}]
+
+        raw, xml1 = xmlarticle.transform([self._article_meta, ET.Element('doc')])
+        raw, xml2 = xmlarticle.transform([other, ET.Element('doc')])
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(
+            xml2.find('./field[@name="journal_title"]').text,
+            'Revista de Saude Publica (spa)')
+
+
+class MemoizedArticleTests(unittest.TestCase):
+
+    def setUp(self):
+        self._raw_json = json.loads(open(os.path.dirname(__file__)+'/fixtures/article_meta.json').read())
+
+        self._article_meta = Article(self._raw_json)
+
+    def test_setup_document_wraps_article(self):
+        raw, xml = pipeline_xml.SetupDocument().transform(self._article_meta)
+
+        self.assertIsInstance(raw, pipeline_xml.MemoizedArticle)
+        self.assertEqual(raw.publisher_id, self._article_meta.publisher_id)
+
+    def test_methods_are_computed_once(self):
+        calls = []
+
+        class FakeArticle(object):
+
+            def original_title(self, iso_format=None):
+                calls.append(iso_format)
+                return 'title'
+
+        raw = pipeline_xml.MemoizedArticle(FakeArticle())
+
+        self.assertEqual(raw.original_title(), 'title')
+        self.assertEqual(raw.original_title(), 'title')
+        raw.original_title(iso_format='iso 639-2')
+
+        self.assertEqual(calls, [None, 'iso 639-2'])
+
+    def test_same_output_as_article(self):
+        raw = pipeline_xml.MemoizedArticle(self._article_meta)
+
+        for pipe in [pipeline_xml.Titles(), pipeline_xml.Abstract(), pipeline_xml.AvailableLanguages()]:
+            expected = pipe.transform([self._article_meta, ET.Element('doc')])[1]
+            result = pipe.transform([raw, ET.Element('doc')])[1]
+
+            self.assertEqual(ET.tostring(expected), ET.tostring(result))
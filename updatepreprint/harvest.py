@@ -0,0 +1,258 @@
+# coding: utf-8
+import os
+import json
+import queue
+import threading
+from datetime import datetime
+
+STATE_PATH = os.environ.get('PREPRINT_STATE', None)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+QUEUE_DEPTH = 100
+
+_END = object()
+
+
+class HarvestState(object):
+    """
+    Checkpoint of the OAI harvest kept in a JSON file.
+
+    ``harvest_from`` and ``harvest_until`` are the range of the current
+    harvest, ``running`` until it reaches its end. ``resumption_token`` is
+    the token that fetched the page of the last record sent to Solr, None
+    when the harvest started from the first page or reached its end, and
+    ``datestamp`` is the newest datestamp among the records of the current
+    harvest sent to Solr. Resuming from the token fetches that page again,
+    so its records already indexed are indexed once more, which is harmless.
+    The records are not listed in datestamp order, so an interrupted harvest
+    whose token expired is harvested again over its whole range.
+
+    ``last_success`` is the newest datestamp of the last harvest that reached
+    its end, the ``from`` of the next incremental harvest.
+
+    :param path: state file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.resumption_token = None
+        self.datestamp = None
+        self.harvest_from = None
+        self.harvest_until = None
+        self.running = False
+        self.last_success = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = {}
+
+        self.resumption_token = data.get('resumption_token')
+        self.datestamp = data.get('datestamp')
+        self.harvest_from = data.get('harvest_from')
+        self.harvest_until = data.get('harvest_until')
+        self.running = data.get('running', False)
+        self.last_success = data.get('last_success')
+
+    def save(self):
+        data = {
+            'resumption_token': self.resumption_token,
+            'datestamp': self.datestamp,
+            'harvest_from': self.harvest_from,
+            'harvest_until': self.harvest_until,
+            'running': self.running,
+            'last_success': self.last_success,
+        }
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def start(self, harvest_from=None, harvest_until=None):
+        """
+        Record the start of a harvest from its first page.
+
+        :param harvest_from: ``from`` datestamp, None for every record
+        :param harvest_until: ``until`` datestamp, None for every record
+        """
+        with self._lock:
+            self.resumption_token = None
+            self.datestamp = None
+            self.harvest_from = harvest_from
+            self.harvest_until = harvest_until
+            self.running = True
+            self.save()
+
+    def checkpoint(self, resumption_token, datestamp):
+        """
+        Record the position of the last record sent to Solr.
+
+        :param resumption_token: token that fetched the page of the record
+        :param datestamp: OAI datestamp of the record
+        """
+        with self._lock:
+            self.resumption_token = resumption_token
+            if datestamp and (self.datestamp is None or datestamp > self.datestamp):
+                self.datestamp = datestamp
+            self.save()
+
+    def finish(self, datestamp=None):
+        """
+        Record a harvest that reached its end.
+
+        :param datestamp: newest datestamp of the harvest, when it was not
+        checkpointed
+        """
+        with self._lock:
+            self.resumption_token = None
+            self.running = False
+            if datestamp and (self.datestamp is None or datestamp > self.datestamp):
+                self.datestamp = datestamp
+            if self.datestamp:
+                self.last_success = self.datestamp
+            self.save()
+
+
+def _token(resumption_token):
+    if resumption_token is None:
+        return None
+
+    return resumption_token.token or None
+
+
+def pages(records, resumption_token=None):
+    """
+    Yield ``(record, token)`` pairs from a sickle ``ListRecords`` iterator,
+    where ``token`` is the resumption token that fetched the page of the
+    record, or None for the first page.
+
+    Sickle keeps in ``resumption_token`` the token of the next page, replaced
+    as soon as that page is fetched, so a new token means the previous one
+    fetched the current page.
+
+    :param records: sickle records iterator
+    :param resumption_token: token that fetched the first page, when resuming
+    """
+    page = resumption_token
+    following = getattr(records, 'resumption_token', None)
+
+    for record in records:
+        current = getattr(records, 'resumption_token', None)
+
+        if current is not following:
+            page, following = _token(following), current
+
+        yield record, page
+
+
+def parse_datestamp(datestamp):
+    """
+    Parse an OAI datestamp with the day or the seconds granularity.
+    """
+    try:
+        return datetime.strptime(datestamp, DATE_FORMAT)
+    except ValueError:
+        return datetime.strptime(datestamp, '%Y-%m-%d')
+
+
+def split_windows(start, end, count):
+    """
+    Split the ``start`` to ``end`` range in ``count`` consecutive windows of
+    the same length, returned as ``(from, until)`` pairs of OAI datestamps.
+
+    ``from`` and ``until`` are inclusive, so neighbouring windows share their
+    boundary and the records stamped on it are harvested twice.
+
+    :param start: datetime.datetime
+    :param end: datetime.datetime
+    :param count: number of windows
+    """
+    count = max(count, 1)
+    step = (end - start) / count
+    bounds = [start + step * i for i in range(count)] + [end]
+
+    return [
+        (bounds[i].strftime(DATE_FORMAT), bounds[i + 1].strftime(DATE_FORMAT))
+        for i in range(count)
+    ]
+
+
+def merge_windows(harvest, windows, depth=QUEUE_DEPTH):
+    """
+    Harvest every window in its own thread, yielding the records as they
+    arrive. A record harvested again with the same OAI identifier, on a
+    shared boundary or because it changed during the harvest, is skipped
+    unless its datestamp is newer than the one already yielded, so the newer
+    copy is indexed after the stale one.
+
+    Errors raised while harvesting a window stop the other windows and are
+    raised in the calling thread.
+
+    :param harvest: callable receiving a ``(from, until)`` window and
+    returning an iterable of sickle records
+    :param windows: list of windows
+    :param depth: size of the queue of harvested records
+    """
+    records = queue.Queue(depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def run(window):
+        try:
+            for record in harvest(window):
+                if not put(record):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(_END)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in windows]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    seen = {}
+    running = len(threads)
+
+    try:
+        while running and not errors:
+            try:
+                record = records.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if record is _END:
+                running -= 1
+                continue
+
+            identifier = record.header.identifier
+            datestamp = record.header.datestamp or ''
+
+            if identifier in seen and datestamp <= seen[identifier]:
+                continue
+
+            seen[identifier] = datestamp
+            yield record
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
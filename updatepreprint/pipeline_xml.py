@@ -1,4 +1,6 @@
 # coding: utf-8
+import functools
+
 from lxml import etree as ET
 
 import plumber
@@ -43,34 +45,123 @@ ns = {'dc': 'http://purl.org/dc/elements/1.1/',
       'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
       'oai': 'http://www.openarchives.org/OAI/2.0/'}
 
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+LANG_CACHE_SIZE = 512
+
+FULL_TAG = 'full'
+PRIMARY_SUBTAG = 'primary'
+TWO_LETTERS = 'two_letters'
+
+OAI_DC = ET.XPath(
+    './/oai_dc:dc',
+    namespaces={'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/'})
+
+
+class DCRecord(object):
+    """
+    Dublin Core elements of an OAI record, read in a single walk of its
+    ``oai_dc:dc`` element.
+
+    Elements carrying a language, such as titles, descriptions and subjects,
+    are kept as ``(text, lang)`` pairs, the others as their text.
+
+    :param raw: lxml element of the OAI record
+    """
+
+    ELEMENTS = {
+        'identifier': 'identifiers',
+        'language': 'languages',
+        'description': 'descriptions',
+        'title': 'titles',
+        'subject': 'subjects',
+        'creator': 'creators',
+        'rights': 'rights',
+        'date': 'dates',
+    }
+
+    WITH_LANG = ('descriptions', 'titles', 'subjects')
+
+    TAGS = dict(
+        ('{%s}%s' % (ns['dc'], element), name)
+        for element, name in ELEMENTS.items()
+    )
+
+    __slots__ = tuple(ELEMENTS.values())
+
+    def __init__(self, raw):
+        for name in self.ELEMENTS.values():
+            setattr(self, name, [])
+
+        found = OAI_DC(raw)
+        root = found[0] if found else raw
+
+        for element in root.iter(*self.TAGS):
+            name = self.TAGS[element.tag]
+
+            if name in self.WITH_LANG:
+                getattr(self, name).append((element.text, element.get(XML_LANG)))
+            else:
+                getattr(self, name).append(element.text)
+
+
+@functools.lru_cache(maxsize=LANG_CACHE_SIZE)
+def normalize_lang(tag, variant=FULL_TAG):
+    """
+    Standardize a language tag with ``langcodes.standardize_tag``, keeping
+    the results of the most recent distinct tags.
+
+    With ``PRIMARY_SUBTAG`` only the primary subtag is standardized (``pt``
+    of ``pt-BR``), with ``TWO_LETTERS`` only the first two characters.
+
+    :param tag: language tag, such as ``pt-BR``
+    :param variant: ``FULL_TAG``, ``PRIMARY_SUBTAG`` or ``TWO_LETTERS``
+    """
+    if variant == PRIMARY_SUBTAG:
+        tag = tag.split('-')[0]
+    elif variant == TWO_LETTERS:
+        tag = tag[0:2]
+
+    return standardize_tag(tag)
+
+
+def dc_record(raw):
+    """
+    Return the ``DCRecord`` of a record, parsing it when the pipe receives
+    the OAI record itself instead of the structure built by
+    ``SetupDocument``.
+    """
+    if isinstance(raw, DCRecord):
+        return raw
+
+    return DCRecord(raw)
+
 
 class SetupDocument(plumber.Pipe):
 
     def transform(self, data):
         xml = ET.Element('doc')
 
-        return data, xml
+        return dc_record(data), xml
 
 
 # <field name="id">art-S0102-695X2015000100053-scl</field>
 class DocumentID(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).identifiers:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        for identifier in raw.findall(xpath, namespaces=ns):
-            if identifier.text.startswith('http'):
+        for identifier in dc_record(raw).identifiers:
+            if identifier.startswith('http'):
                 field = ET.Element('field')
-                field.text = "preprint_%s" % (identifier.text.split('/')[-1])
+                field.text = "preprint_%s" % (identifier.split('/')[-1])
                 field.set('name', 'id')
                 xml.find('.').append(field)
 
@@ -81,21 +172,19 @@ class DocumentID(plumber.Pipe):
 class URL(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).identifiers:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        for url in raw.findall(xpath, namespaces=ns):
-            if url.text.startswith('http'):
+        for url in dc_record(raw).identifiers:
+            if url.startswith('http'):
                 field = ET.Element('field')
-                field.text = url.text
+                field.text = url
                 field.set('name', 'ur')
                 xml.find('.').append(field)
 
@@ -106,21 +195,19 @@ class URL(plumber.Pipe):
 class DOI(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).identifiers:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        for doi in raw.findall(xpath, namespaces=ns):
-            if not doi.text.startswith('http'):
+        for doi in dc_record(raw).identifiers:
+            if not doi.startswith('http'):
                 field = ET.Element('field')
-                field.text = doi.text
+                field.text = doi
                 field.set('name', 'doi')
                 xml.find('.').append(field)
 
@@ -130,21 +217,19 @@ class DOI(plumber.Pipe):
 class Languages(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:language"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).languages:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:language"
         raw, xml = data
 
-        for lang in raw.findall(xpath, namespaces=ns):
+        for lang in dc_record(raw).languages:
             field = ET.Element('field')
 
-            field.text = standardize_tag(lang.text)
+            field.text = normalize_lang(lang)
             field.set('name', 'la')
             xml.find('.').append(field)
 
@@ -155,23 +240,24 @@ class Languages(plumber.Pipe):
 class Fulltexts(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:identifier"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).identifiers:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:identifier"
         raw, xml = data
+        record = dc_record(raw)
 
-        for url in raw.findall(xpath, namespaces=ns):
-            if url.text.startswith('http'):
-                for lang in raw.findall(".//dc:language", namespaces=ns):
+        langs = [normalize_lang(lang) for lang in record.languages]
+
+        for url in record.identifiers:
+            if url.startswith('http'):
+                for lang in langs:
                     field = ET.Element('field')
-                    field.text = url.text
-                    field.set('name', 'fulltext_html_%s' % standardize_tag(lang.text))
+                    field.text = url
+                    field.set('name', 'fulltext_html_%s' % lang)
                     xml.find('.').append(field)
         return data
 
@@ -180,20 +266,18 @@ class Fulltexts(plumber.Pipe):
 class PublicationDate(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:date"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).dates:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
-        xpath = ".//dc:date"
         raw, xml = data
 
-        for date in raw.findall(xpath, namespaces=ns):
+        for date in dc_record(raw).dates:
             field = ET.Element('field')
-            field.text = date.text
+            field.text = date
             field.set('name', 'da')
             xml.find('.').append(field)
         return data
@@ -203,24 +287,19 @@ class PublicationDate(plumber.Pipe):
 class Abstract(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:description"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).descriptions:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:description"
 
-        for item in raw.findall(xpath, namespaces=ns):
-            lang = item.get('{http://www.w3.org/XML/1998/namespace}lang')
-            if "-" in lang:
-                lang = lang.split("-")[0]
+        for text, lang in dc_record(raw).descriptions:
             field = ET.Element('field')
-            field.text = item.text
-            field.set('name', 'ab_{}'.format(standardize_tag(lang)))
+            field.text = text
+            field.set('name', 'ab_{}'.format(normalize_lang(lang, PRIMARY_SUBTAG)))
             xml.find('.').append(field)
         return data
 
@@ -230,14 +309,10 @@ class AvailableLanguages(plumber.Pipe):
 
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:description"
 
         langs = set()
-        for item in raw.findall(xpath, namespaces=ns):
-            lang = item.get('{http://www.w3.org/XML/1998/namespace}lang')
-            if "-" in lang:
-                lang = lang.split("-")[0]
-            langs.add(standardize_tag(lang))
+        for text, lang in dc_record(raw).descriptions:
+            langs.add(normalize_lang(lang, PRIMARY_SUBTAG))
 
         for language in langs:
             field = ET.Element('field')
@@ -252,22 +327,19 @@ class AvailableLanguages(plumber.Pipe):
 class Keywords(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:subject"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).subjects:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:subject"
 
-        for item in raw.findall(xpath, namespaces=ns):
-            lang = item.get('{http://www.w3.org/XML/1998/namespace}lang')
+        for text, lang in dc_record(raw).subjects:
             field = ET.Element('field')
-            field.text = item.text
-            field.set('name', 'keyword_{}'.format(standardize_tag(lang[0:2])))
+            field.text = text
+            field.set('name', 'keyword_{}'.format(normalize_lang(lang, TWO_LETTERS)))
             xml.find('.').append(field)
         return data
 
@@ -288,30 +360,28 @@ class IsCitable(plumber.Pipe):
 class Permission(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:rights"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).rights:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:rights"
 
-        for item in raw.findall(xpath, namespaces=ns):
-            if not item.text.startswith('http'):
+        for item in dc_record(raw).rights:
+            if not item.startswith('http'):
                 field = ET.Element('field')
-                field.text = item.text
+                field.text = item
                 field.set('name', 'use_license_text')
                 xml.find('.').append(field)
             else:
                 field = ET.Element('field')
-                field.text = item.text
+                field.text = item
                 field.set('name', 'use_license_uri')
                 xml.find('.').append(field)
                 field = ET.Element('field')
-                field.text = item.text
+                field.text = item
                 field.set('name', 'use_license_ur')
                 xml.find('.').append(field)
         return data
@@ -345,20 +415,18 @@ class DocumentType(plumber.Pipe):
 class Authors(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:creator"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).creators:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:creator"
 
-        for author in raw.findall(xpath, namespaces=ns):
+        for author in dc_record(raw).creators:
             field = ET.Element('field')
-            field.text = author.text
+            field.text = author
             field.set('name', 'au')
             xml.find('.').append(field)
         return data
@@ -368,23 +436,20 @@ class Authors(plumber.Pipe):
 class Titles(plumber.Pipe):
 
     def precond(data):
-        xpath = ".//dc:title"
         raw, xml = data
 
-        if not raw.findall(xpath, namespaces=ns):
+        if not dc_record(raw).titles:
             raise plumber.UnmetPrecondition()
 
     @plumber.precondition(precond)
     def transform(self, data):
         raw, xml = data
-        xpath = ".//dc:title"
 
-        for item in raw.findall(xpath, namespaces=ns):
-            lang = item.get('{http://www.w3.org/XML/1998/namespace}lang')
+        for text, lang in dc_record(raw).titles:
             if "-" in lang:
                 lang = lang.split("-")[0]
             field = ET.Element('field')
-            field.text = item.text
+            field.text = text
             field.set('name', 'ti_{}'.format(lang))
             xml.find('.').append(field)
         return data
@@ -7,6 +7,7 @@ import os
 import sys
 import time
 import argparse
+import functools
 import textwrap
 from datetime import datetime, timedelta
 
@@ -14,8 +15,13 @@ from lxml import etree as ET
 
 import plumber
 from updatepreprint import pipeline_xml
+from updatepreprint.harvest import (
+    HarvestState, pages, split_windows, merge_windows, parse_datestamp,
+    STATE_PATH, DATE_FORMAT)
+from updatesearch.workers import StagedExecutor, SourceError, guard_source
+from updatesearch.writer import BatchWriter, BATCH_SIZE, TIMEOUT
 from sickle import Sickle
-from sickle.oaiexceptions import NoRecordsMatch
+from sickle.oaiexceptions import NoRecordsMatch, BadResumptionToken
 
 from SolrAPI import Solr
 
@@ -35,6 +41,9 @@ class UpdatePreprint(object):
                         type=int,
                         help='index articles from specific period, use number of hours.')
 
+    parser.add_argument('-u', '--until',
+                        help='index articles up to this OAI datestamp, ex.: 2020-04-30T23:59:59Z.')
+
     parser.add_argument('-d', '--delete',
                         dest='delete',
                         help='delete query ex.: q=type:"preprint (Lucene Syntax).')
@@ -48,6 +57,38 @@ class UpdatePreprint(object):
                         default="http://preprints.scielo.org/index.php/scielo/oai",
                         help='OAI URL, processing try to get the variable from environment ``OAI_URL`` otherwise use --oai_url to set the oai_url (preferable).')
 
+    parser.add_argument('-q', '--queue_depth',
+                        type=int,
+                        default=0,
+                        help='run harvest, transform and Solr writes as pipelined stages connected by queues of this size, 0 runs them sequentially (default 0).')
+
+    parser.add_argument('-b', '--batch_size',
+                        type=int,
+                        default=BATCH_SIZE,
+                        help='number of records sent to Solr per request (default %d).' % BATCH_SIZE)
+
+    parser.add_argument('--commit_within',
+                        type=int,
+                        default=0,
+                        help='milliseconds Solr may wait before committing each batch of records, 0 leaves it to the commit at the end (default 0).')
+
+    parser.add_argument('-n', '--windows',
+                        type=int,
+                        default=1,
+                        help='split the harvested period in this number of windows harvested concurrently, each one by its own OAI client (default 1).')
+
+    parser.add_argument('--state',
+                        default=STATE_PATH,
+                        help='file where the harvest is checkpointed after every batch sent to Solr, processing try to get the variable from environment ``PREPRINT_STATE``.')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='continue the harvest from the resumption token saved in --state.')
+
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='index the records changed since the last harvest that reached its end, saved in --state.')
+
     parser.add_argument('-v', '--version',
                         action='version',
                         version='version: 0.1-beta')
@@ -66,21 +107,34 @@ class UpdatePreprint(object):
             raise argparse.ArgumentTypeError('--oai_url or ``OAI_URL`` enviroment variable must be the set, use --help.')
 
         if not solr_url:
-            self.solr = Solr(self.args.solr_url, timeout=10)
+            self.solr = Solr(self.args.solr_url, timeout=TIMEOUT)
         else:
-            self.solr = Solr(solr_url, timeout=10)
+            self.solr = Solr(solr_url, timeout=TIMEOUT)
+
+        if (self.args.resume or self.args.incremental) and not self.args.state:
+            raise argparse.ArgumentTypeError('--resume and --incremental require --state or ``PREPRINT_STATE`` enviroment variable, use --help.')
+
+        if self.args.resume and self.args.windows > 1:
+            raise argparse.ArgumentTypeError('--resume can not be used with --windows, use --help.')
 
         if self.args.time:
             self.from_date = datetime.now() - timedelta(hours=self.args.time)
 
-    def pipeline_to_xml(self, article):
+        self.state = None
+        if self.args.state:
+            self.state = HarvestState(self.args.state)
+
+        self._pipeline = None
+
+    def build_pipeline(self):
         """
-        Pipeline to tranform a dictionary to XML format
+        Build the pipeline to tranform OAI records in ``<doc>`` elements.
 
-        :param list_dict: List of dictionary content key tronsform in a XML.
+        The pipes are stateless, so the same pipeline is reused for every
+        record of the harvest.
         """
 
-        ppl = plumber.Pipeline(
+        return plumber.Pipeline(
             pipeline_xml.SetupDocument(),
 
             pipeline_xml.DocumentID(),
@@ -100,7 +154,21 @@ class UpdatePreprint(object):
             pipeline_xml.TearDown()
         )
 
-        xmls = ppl.run([article])
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self.build_pipeline()
+
+        return self._pipeline
+
+    def pipeline_to_xml(self, article):
+        """
+        Pipeline to tranform a dictionary to XML format
+
+        :param list_dict: List of dictionary content key tronsform in a XML.
+        """
+
+        xmls = self.pipeline.run([article])
 
         # Add root document
         add = ET.Element('add')
@@ -110,6 +178,164 @@ class UpdatePreprint(object):
 
         return ET.tostring(add, encoding="utf-8", method="xml")
 
+    def pipeline_stream(self, items):
+        """
+        Run the pipeline over the harvested records yielding lazily one
+        ``(doc, record, token)`` tuple per record, where ``doc`` is the
+        ``<doc>`` element.
+
+        Records that fail to be transformed are reported and skipped, the
+        pipeline is resumed from the next record. Errors raised while
+        harvesting are raised.
+
+        :param items: iterable of ``(record, token)`` pairs from
+        ``updatepreprint.harvest.pages``.
+        """
+        current = []
+
+        def raws():
+            for i, (record, token) in enumerate(guard_source(items)):
+                print("Indexing record %s with oai id: %s" % (i, record.header.identifier))
+                current[:] = [record, token]
+                yield record.xml
+
+        raws = raws()
+
+        while True:
+            try:
+                for xml in self.pipeline.run(raws):
+                    yield xml, current[0], current[1]
+                return
+            except SourceError as e:
+                raise e.error
+            except Exception as e:
+                print("Error: {0}".format(e))
+                print(e)
+
+    def write_stream(self, writer, items):
+        """
+        Add the documents to ``writer``, keeping the position of the harvest
+        checkpointed by ``checkpoint`` after every batch. It is the write
+        stage of a ``updatesearch.workers.StagedExecutor``.
+
+        The position is updated after the document is added, so a batch sent
+        while adding a document is checkpointed with the previous one.
+
+        :param writer: updatesearch.writer.BatchWriter instance
+        :param items: iterable of ``(doc, record, token)`` tuples
+        """
+        datestamp = None
+
+        for xml, record, token in items:
+            writer.add(xml)
+
+            if datestamp is None or record.header.datestamp > datestamp:
+                datestamp = record.header.datestamp
+
+            self._position = (token, datestamp)
+            self._added += 1
+            yield xml
+
+    def checkpoint(self, count):
+        """
+        Save the position of the harvest, called after every batch of
+        ``count`` documents accepted by Solr.
+
+        The windows of a concurrent harvest progress independently, so there
+        is no single position to resume from and they are not checkpointed.
+        """
+        if self.args.windows > 1:
+            return
+
+        if self.state is not None and self._position is not None:
+            self.state.checkpoint(*self._position)
+
+    def harvest_range(self):
+        """
+        Return the ``(from, until)`` datestamps of the harvest, None for an
+        open end.
+
+        With --resume it is the range of the interrupted harvest, with
+        --incremental, or --resume when no harvest was interrupted, it starts
+        at the newest datestamp of the last harvest that reached its end.
+        Otherwise --time sets the start of the harvest. --until sets its end.
+        """
+        if self.args.resume and self.state.running:
+            return self.state.harvest_from, self.state.harvest_until
+        elif (self.args.resume or self.args.incremental) and self.state.last_success:
+            return self.state.last_success, self.args.until
+        elif self.args.time:
+            return self.from_date.strftime(DATE_FORMAT), self.args.until
+
+        return None, self.args.until
+
+    def start(self, harvest_from, harvest_until):
+        if self.state is not None:
+            self.state.start(harvest_from, harvest_until)
+
+    def list_records(self, sickle):
+        """
+        Start the harvest, returning the records iterator and the resumption
+        token that fetched its first page.
+
+        With --resume the harvest continues from the saved resumption token,
+        or over ``harvest_range`` from its first page when there is no token
+        or it has expired.
+        """
+        if self.args.resume and self.state.running and self.state.resumption_token:
+            token = self.state.resumption_token
+            try:
+                print("Resuming harvest from token {0}".format(token))
+                return sickle.ListRecords(resumptionToken=token), token
+            except BadResumptionToken as e:
+                print(e)
+
+        harvest_from, harvest_until = self.harvest_range()
+        filters = {'metadataPrefix': 'oai_dc'}
+
+        if harvest_from:
+            filters['from'] = harvest_from
+
+        if harvest_until:
+            filters['until'] = harvest_until
+
+        self.start(harvest_from, harvest_until)
+
+        return sickle.ListRecords(**filters), None
+
+    def windows(self, sickle):
+        """
+        Split the harvested period in --windows windows. Without a ``from``
+        the period starts at the earliest datestamp of the repository, and
+        without an ``until`` it ends now.
+        """
+        harvest_from, harvest_until = self.harvest_range()
+        start = harvest_from or sickle.Identify().earliestDatestamp
+        end = harvest_until or datetime.utcnow().strftime(DATE_FORMAT)
+
+        self.start(start, end)
+
+        return split_windows(
+            parse_datestamp(start), parse_datestamp(end), self.args.windows)
+
+    def harvest_window(self, window):
+        """
+        Harvest the records of a ``(from, until)`` window with its own OAI
+        client.
+        """
+        sickle = Sickle(self.args.oai_url, verify=False)
+        filters = {'metadataPrefix': 'oai_dc', 'from': window[0], 'until': window[1]}
+
+        print("Harvesting window from {0} until {1}".format(*window))
+
+        try:
+            records = sickle.ListRecords(**filters)
+        except NoRecordsMatch:
+            return
+
+        for record in records:
+            yield record
+
     def run(self):
         """
         Run the process for update Pre-prints in Solr.
@@ -125,31 +351,39 @@ class UpdatePreprint(object):
 
             sickle = Sickle(self.args.oai_url, verify=False)
 
-            filters = {'metadataPrefix': 'oai_dc'}
-
-            if self.args.time:
-                filters['from'] = self.from_date.strftime("%Y-%m-%dT%H:%M:%SZ")
-
             try:
-                records = sickle.ListRecords(**filters)
+                if self.args.windows > 1:
+                    records, token = merge_windows(
+                        self.harvest_window, self.windows(sickle)), None
+                else:
+                    records, token = self.list_records(sickle)
             except NoRecordsMatch as e:
                 print(e)
                 sys.exit(0)
             else:
 
-                for i, record in enumerate(records):
-                    try:
-                        xml = self.pipeline_to_xml(record.xml)
-                        print("Indexing record %s with oai id: %s" % (i, record.header.identifier))
-                        self.solr.update(xml, commit=True)
-                    except ValueError as e:
-                        print("ValueError: {0}".format(e))
-                        print(e)
-                        continue
-                    except Exception as e:
-                        print("Error: {0}".format(e))
-                        print(e)
-                        continue
+                self._position = None
+                self._added = 0
+
+                with BatchWriter(self.solr, self.args.batch_size,
+                                 commit_within=self.args.commit_within,
+                                 on_flush=self.checkpoint) as writer:
+
+                    write_stream = functools.partial(self.write_stream, writer)
+
+                    if self.args.queue_depth:
+                        StagedExecutor([
+                            ('harvest', functools.partial(pages, resumption_token=token)),
+                            ('transform', self.pipeline_stream),
+                            ('write', write_stream)
+                        ], self.args.queue_depth).run(records)
+                    else:
+                        for doc in write_stream(self.pipeline_stream(pages(records, token))):
+                            pass
+
+                # every record reached Solr, the next harvest starts afresh
+                if self.state is not None and writer.total == self._added:
+                    self.state.finish(self._position and self._position[1])
 
         # optimize the index
         self.solr.commit()
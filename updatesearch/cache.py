@@ -0,0 +1,206 @@
+# coding: utf-8
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get('INDICATORS_CACHE', None)
+CACHE_TTL = 168
+CACHE_MAX_ENTRIES = 5000000
+COMMIT_INTERVAL = 1000
+
+ACCESSES = 'accesses'
+CITATIONS = 'citations'
+
+
+class IndicatorsCache(object):
+    """
+    Single file cache of the document indicators (accesses and received
+    citations), keyed by indicator, PID and collection.
+
+    Each entry expires ``ttl`` hours after it is stored. When the cache holds
+    more than ``max_entries`` entries the oldest ones are evicted. With
+    ``refresh`` the cached values are ignored, but the fetched ones are still
+    stored.
+
+    The cache may be shared by threads.
+
+    :param path: sqlite database file
+    :param ttl: time to live of the entries in hours
+    :param max_entries: maximum number of entries
+    :param refresh: ignore the cached values
+    """
+
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 refresh=False):
+        self.path = path
+        self.ttl = ttl * 3600
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS indicators ('
+            'indicator TEXT, pid TEXT, collection TEXT, value INTEGER, '
+            'updated REAL, expires REAL, '
+            'PRIMARY KEY (indicator, pid, collection))'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS indicators_updated ON indicators (updated)')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM indicators').fetchone()[0]
+
+    def get(self, indicator, publisher_id, collection):
+        """
+        Return the cached value or None when it is not cached or expired.
+        """
+        if self.refresh:
+            return None
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM indicators WHERE indicator=? AND pid=? '
+                'AND collection=? AND expires>?',
+                (indicator, publisher_id, collection, time.time())
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def last(self, indicator, publisher_id, collection):
+        """
+        Return the last stored value, even when it is expired, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM indicators WHERE indicator=? AND pid=? '
+                'AND collection=?',
+                (indicator, publisher_id, collection)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, indicator, publisher_id, collection, value):
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO indicators VALUES (?, ?, ?, ?, ?, ?)',
+                (indicator, publisher_id, collection, value, now, now + self.ttl)
+            )
+            self._writes += 1
+
+            if self._writes % COMMIT_INTERVAL == 0:
+                self._evict()
+                self._conn.commit()
+
+    def fetch(self, indicator, publisher_id, collection, func):
+        """
+        Return the cached value, calling ``func()`` and caching its result
+        when it is not cached.
+        """
+        value = self.get(indicator, publisher_id, collection)
+
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            self.misses += 1
+        value = func()
+        self.set(indicator, publisher_id, collection, value)
+
+        return value
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COUNT(*) FROM indicators').fetchone()[0]
+
+        if total <= self.max_entries:
+            return
+
+        self._conn.execute(
+            'DELETE FROM indicators WHERE rowid IN ('
+            'SELECT rowid FROM indicators ORDER BY updated, rowid LIMIT ?)',
+            (total - self.max_entries,)
+        )
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.commit()
+            self._conn.close()
+
+        logger.info("Indicators cache: (%d) hits, (%d) misses." % (self.hits, self.misses))
+
+
+def cached(cache, indicator, publisher_id, collection, func):
+    """
+    Return ``cache.fetch(...)`` or just ``func()`` when there is no cache.
+    """
+    if cache is None:
+        return func()
+
+    return cache.fetch(indicator, publisher_id, collection, func)
+
+
+def add_arguments(parser):
+    """
+    Add the indicators cache options to an argparse parser.
+    """
+    parser.add_argument(
+        '--cache',
+        default=CACHE_PATH,
+        help='sqlite file caching the accesses and citations counts, the processing try to get the variable from environment ``INDICATORS_CACHE`` (default no cache).'
+    )
+
+    parser.add_argument(
+        '--cache_ttl',
+        type=int,
+        default=CACHE_TTL,
+        help='hours a cached count is valid (default %d).' % CACHE_TTL
+    )
+
+    parser.add_argument(
+        '--cache_max_entries',
+        type=int,
+        default=CACHE_MAX_ENTRIES,
+        help='maximum number of cached counts, the oldest are evicted (default %d).' % CACHE_MAX_ENTRIES
+    )
+
+    parser.add_argument(
+        '--refresh_cache',
+        default=False,
+        action='store_true',
+        help='ignore the cached counts, fetching and caching them again.'
+    )
+
+
+def from_arguments(args):
+    """
+    Return the ``IndicatorsCache`` configured by the options added with
+    ``add_arguments`` or None when no cache file is given.
+    """
+    if not args.cache:
+        return None
+
+    return IndicatorsCache(
+        args.cache,
+        ttl=args.cache_ttl,
+        max_entries=args.cache_max_entries,
+        refresh=args.refresh_cache
+    )
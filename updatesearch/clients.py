@@ -0,0 +1,94 @@
+# coding: utf-8
+import threading
+
+ARTICLEMETA = 'articlemeta'
+CITEDBY = 'citedby'
+RATCHET = 'ratchet'
+
+CITEDBY_DOMAIN = 'citedby.scielo.org:11610'
+RATCHET_DOMAIN = 'ratchet.scielo.org:11660'
+
+
+def articlemeta_client():
+    from articlemeta.client import ThriftClient
+
+    return ThriftClient()
+
+
+def citedby_client():
+    from citedby.client import ThriftClient
+
+    return ThriftClient(domain=CITEDBY_DOMAIN)
+
+
+def accessstats_client():
+    from accessstats.client import ThriftClient
+
+    return ThriftClient(domain=RATCHET_DOMAIN)
+
+
+class ClientRegistry(object):
+    """
+    Lazily created clients shared by the whole process, one per upstream.
+
+    Each client is built by the factory registered with its name the first
+    time it is requested, and the factories import the client packages, so
+    the processes that never talk to an upstream service, such as
+    ``update_search`` without ``--load_indicators`` or the transform worker
+    processes, do not pay for them. The registry may be shared by threads.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        """
+        Register the factory of a client, dropping the client already created
+        with the same name.
+
+        :param name: upstream name
+        :param factory: callable returning a new client
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._clients.pop(name, None)
+
+    def get(self, name):
+        """
+        Return the client of an upstream, creating it on the first call.
+        """
+        try:
+            return self._clients[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = self._factories[name]()
+
+            return self._clients[name]
+
+    def created(self, name):
+        return name in self._clients
+
+    def reset(self):
+        """
+        Drop the created clients, they are created again when requested.
+        """
+        with self._lock:
+            self._clients.clear()
+
+
+registry = ClientRegistry()
+registry.register(ARTICLEMETA, articlemeta_client)
+registry.register(CITEDBY, citedby_client)
+registry.register(RATCHET, accessstats_client)
+
+
+def get(name):
+    """
+    Return the shared client of an upstream from the default registry.
+    """
+    return registry.get(name)
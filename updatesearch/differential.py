@@ -0,0 +1,117 @@
+# coding: utf-8
+import heapq
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+SORT_BUFFER = 500000
+
+INCLUDE = 'include'
+UPDATE = 'update'
+REMOVE = 'remove'
+
+
+def _dump(lines, files):
+    lines.sort()
+    spill = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    spill.writelines(lines)
+    spill.seek(0)
+    files.append(spill)
+    logger.debug("Spilled (%d) sorted keys to disk." % len(lines))
+
+
+def sorted_stream(items, buffer_size=SORT_BUFFER):
+    """
+    Sort ``(id, value)`` pairs by id, yielding them lazily.
+
+    At most ``buffer_size`` pairs are kept in memory, bigger inputs are
+    sorted in chunks spilled to temporary files which are merged at the end.
+    Neither the id nor the value may contain tabs or line breaks. An id
+    repeated in the input, such as by an offset-paged listing, is yielded
+    once, with its first value in sort order.
+
+    :param items: iterable of ``(id, value)`` pairs
+    :param buffer_size: maximum number of pairs sorted in memory
+
+    :returns: iterator of ``(id, value)`` pairs sorted by id
+    """
+    files = []
+    lines = []
+
+    try:
+        for id, value in items:
+            lines.append('%s\t%s\n' % (id, value))
+
+            if len(lines) >= buffer_size:
+                _dump(lines, files)
+                lines = []
+
+        if files and lines:
+            _dump(lines, files)
+            lines = []
+
+        lines.sort()
+        previous = None
+        for line in heapq.merge(lines, *files):
+            id, value = line.rstrip('\n').split('\t', 1)
+            if id == previous:
+                continue
+            previous = id
+            yield id, value
+    finally:
+        for spill in files:
+            spill.close()
+
+
+def _check_order(items, name):
+    previous = None
+
+    for item in items:
+        if previous is not None and item[0] == previous:
+            logger.debug("%s id repeated: %s" % (name, item[0]))
+            continue
+        if previous is not None and item[0] < previous:
+            raise ValueError(
+                "%s ids are not sorted: %s after %s" % (name, item[0], previous))
+        previous = item[0]
+        yield item
+
+
+def diff(index_items, source_items):
+    """
+    Compare in a single merge pass the documents available in the search
+    index with the documents available in the source.
+
+    Both iterables must yield ``(id, processing_date)`` pairs sorted by id,
+    so only the current pair of each side is kept in memory. Repeated ids are
+    compared once, with their first pair.
+
+    Yields ``(action, id, processing_date)`` tuples, where action is:
+
+    * ``INCLUDE`` for ids available only in the source;
+    * ``UPDATE`` for ids available in both sides with different processing
+      dates;
+    * ``REMOVE`` for ids available only in the search index.
+
+    :param index_items: pairs from the search index sorted by id
+    :param source_items: pairs from the source sorted by id
+    """
+    index_items = _check_order(index_items, 'Search index')
+    source_items = _check_order(source_items, 'Source')
+
+    index = next(index_items, None)
+    source = next(source_items, None)
+
+    while index is not None or source is not None:
+        if source is None or (index is not None and index[0] < source[0]):
+            yield REMOVE, index[0], index[1]
+            index = next(index_items, None)
+        elif index is None or source[0] < index[0]:
+            yield INCLUDE, source[0], source[1]
+            source = next(source_items, None)
+        else:
+            if index[1] != source[1]:
+                yield UPDATE, source[0], source[1]
+            index = next(index_items, None)
+            source = next(source_items, None)
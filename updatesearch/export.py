@@ -0,0 +1,102 @@
+# coding: utf-8
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 10000
+
+
+def build_query(collection=None, issn=None, from_date=None):
+    """
+    Build the Solr query selecting the documents of a collection and/or a
+    journal, optionally processed since a date.
+
+    :param collection: collection acronym
+    :param issn: journal issn
+    :param from_date: datetime.datetime of the oldest processing date
+
+    :returns: str
+    """
+    itens_query = []
+
+    if collection:
+        itens_query.append('in:%s' % collection)
+
+    if issn:
+        itens_query.append('issn:%s' % issn)
+
+    if from_date:
+        itens_query.append(
+            'scielo_processing_date:[%s TO *]' % from_date.strftime('%Y-%m-%d'))
+
+    return '*:*' if len(itens_query) == 0 else ' AND '.join(itens_query)
+
+
+def export_docs(solr, query, fields='id', page_size=PAGE_SIZE):
+    """
+    Iterate lazily over all the documents matching ``query``.
+
+    The documents are paged with ``cursorMark`` sorted by ``id``, so there is
+    no limit on the number of exported documents and a single page is held
+    in memory at a time.
+
+    :param solr: SolrAPI.Solr instance
+    :param query: Solr query string
+    :param fields: comma separated list of fields to export
+    :param page_size: number of documents per request
+
+    :returns: iterator of dicts
+    """
+    cursor = '*'
+
+    while True:
+        result = json.loads(solr.select({
+            'q': query,
+            'fl': fields,
+            'rows': page_size,
+            'sort': 'id asc',
+            'cursorMark': cursor
+        }))
+
+        for doc in result['response']['docs']:
+            yield doc
+
+        next_cursor = result['nextCursorMark']
+
+        if next_cursor == cursor:
+            return
+
+        cursor = next_cursor
+
+
+def export_ids(solr, query, page_size=PAGE_SIZE):
+    """
+    Iterate lazily over the ids of the documents matching ``query``, sorted
+    by id.
+
+    :param solr: SolrAPI.Solr instance
+    :param query: Solr query string
+    :param page_size: number of documents per request
+
+    :returns: iterator of str
+    """
+    for doc in export_docs(solr, query, fields='id', page_size=page_size):
+        yield doc['id']
+
+
+def split_id(document_id):
+    """
+    Split an article id of the search index in PID and collection acronym.
+
+    :param document_id: Solr id like ``S0034-89102010000400007-scl``
+
+    :returns: ``(pid, collection)`` or None for ids of other kinds, such as
+    the preprints ids.
+    """
+    pid, sep, collection = document_id.rpartition('-')
+
+    if not pid or not collection:
+        return None
+
+    return pid, collection
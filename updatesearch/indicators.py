@@ -0,0 +1,552 @@
+# coding: utf-8
+import os
+import json
+import fcntl
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from updatesearch.workers import (
+    ThreadLocalClient, CircuitBreaker, CircuitOpenError, imap_unordered)
+from updatesearch.cache import cached, CITATIONS
+from updatesearch.export import export_docs, split_id, PAGE_SIZE
+from updatesearch.clients import citedby_client
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_CONCURRENCY = 8
+BACKFILL_PATH = os.environ.get('INDICATORS_BACKFILL', None)
+CALL_TIMEOUT = 30
+ERROR_THRESHOLD = 0.5
+BREAKER_WINDOW = 20
+BREAKER_RESET = 60
+WATERMARK_PATH = os.environ.get('INDICATORS_WATERMARK', None)
+FULL_SWEEP = 30
+LOOKUP_SIZE = 100
+
+SOURCES = ('solr', 'articlemeta', 'backfill')
+
+
+def received_citations(client, publisher_id):
+    """
+    Return the total of citations received by a document.
+
+    :param client: citedby.client.ThriftClient instance
+    :param publisher_id: document PID
+    """
+    result = client.citedby_pid(publisher_id, metaonly=True)
+
+    return result.get('article', {'total_received': 0})['total_received']
+
+
+def access_total(client, publisher_id, collection):
+    """
+    Return the total of accesses of a document.
+
+    :param client: accessstats.client.ThriftClient instance
+    :param publisher_id: document PID
+    :param collection: collection acronym
+    """
+    result = client.document(publisher_id, collection)
+
+    return int(result.get('access_total', {'value': 0})['value'])
+
+
+def guarded(breaker, func, *args, **kwargs):
+    """
+    Call ``func(*args)`` through ``breaker`` or directly when there is no
+    circuit breaker.
+
+    With a ``limiter`` keyword, an ``updatesearch.workers.RateLimiter``, a
+    slot is taken before the call and released when ``func`` returns, even
+    when the breaker stopped waiting for it, so the calls abandoned by the
+    breaker timeout are still limited by ``max_in_flight``.
+    """
+    limiter = kwargs.pop('limiter', None)
+
+    if limiter is not None:
+        limiter.acquire()
+        func = limiter.releasing(func)
+
+    try:
+        if breaker is None:
+            return func(*args)
+
+        return breaker.call(func, *args)
+    except CircuitOpenError:
+        # the circuit is open and func was not called
+        if limiter is not None:
+            limiter.release()
+        raise
+
+
+def fallback(cache, backfill, indicator, publisher_id, collection):
+    """
+    Handle an indicator that could not be fetched, queuing the document for
+    backfill and returning the last cached value or None.
+
+    :param cache: updatesearch.cache.IndicatorsCache instance or None
+    :param backfill: BackfillQueue instance or None
+    """
+    if backfill is not None:
+        backfill.add(indicator, publisher_id, collection)
+
+    if cache is None:
+        return None
+
+    return cache.last(indicator, publisher_id, collection)
+
+
+class BackfillQueue(object):
+    """
+    File of the documents whose indicators could not be fetched, loaded
+    later by the indicators jobs with ``--source backfill``.
+
+    Each line holds the indicator, the PID and the collection separated by
+    tabs. The queue may be shared by threads and by processes, such as an
+    ``update_search`` run appending to it while a backfill run loads it, so
+    the file is locked while it is changed.
+
+    The entries loaded by a backfill run are read by ``pending`` and stay in
+    the file until ``done`` removes them, once their documents are written,
+    so an interrupted run loads them again.
+
+    :param path: queue file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queued = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, indicator, publisher_id, collection):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write('\t'.join([indicator, publisher_id, collection]) + '\n')
+            self.queued += 1
+
+    @staticmethod
+    def _entries(f):
+        return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return self._entries(f)
+        except IOError:
+            return []
+
+    def pending(self, indicators):
+        """
+        Return the unique ``(publisher_id, collection)`` pairs of the entries
+        of the given indicators, leaving them in the queue until ``done``.
+
+        :param indicators: list of indicators, such as
+        ``updatesearch.cache.ACCESSES``
+        """
+        with self._lock:
+            self._pending = [i for i in self._read() if i[0] in indicators]
+
+        identifiers = []
+        seen = set()
+        for indicator, publisher_id, collection in self._pending:
+            if (publisher_id, collection) not in seen:
+                seen.add((publisher_id, collection))
+                identifiers.append((publisher_id, collection))
+
+        return identifiers
+
+    def done(self):
+        """
+        Remove from the queue the entries returned by the last ``pending``.
+        The entries appended since then are kept, including the ones queued
+        again by the backfill run itself.
+        """
+        with self._lock:
+            remaining = Counter(tuple(i) for i in self._pending)
+            self._pending = []
+
+            if not remaining:
+                return
+
+            try:
+                f = open(self.path, 'r+')
+            except IOError:
+                return
+
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                kept = []
+                for entry in self._entries(f):
+                    if remaining[tuple(entry)]:
+                        remaining[tuple(entry)] -= 1
+                    else:
+                        kept.append(entry)
+
+                f.seek(0)
+                for entry in kept:
+                    f.write('\t'.join(entry) + '\n')
+                f.truncate()
+
+
+class Watermark(object):
+    """
+    Record of the last successful runs of an indicators job, kept in a JSON
+    file that may be shared by the jobs.
+
+    An incremental run refreshes only the documents processed since the last
+    run, and a full sweep over every document is due ``full_sweep`` days
+    after the previous one.
+
+    Runs restricted to a collection or a journal refresh only their
+    documents, so they are recorded apart from the runs over every document.
+
+    :param path: watermark file
+    :param job: job name, such as ``updatesearch.cache.ACCESSES``
+    :param collection: collection acronym the runs are restricted to
+    :param issn: journal ISSN the runs are restricted to
+    """
+
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, path, job, collection=None, issn=None):
+        self.path = path
+        self.job = job
+        if collection or issn:
+            self.job = '%s:%s:%s' % (job, collection or '*', issn or '*')
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _date(self, key):
+        value = self._read().get(self.job, {}).get(key)
+
+        if value is None:
+            return None
+
+        return datetime.strptime(value, self.DATE_FORMAT)
+
+    def last_run(self):
+        return self._date('last_run')
+
+    def last_full_sweep(self):
+        return self._date('last_full_sweep')
+
+    def window_start(self, full_sweep=FULL_SWEEP, now=None):
+        """
+        Return the start of the incremental window, the date of the last
+        run, or None when a full sweep is due.
+
+        :param full_sweep: days between full sweeps
+        """
+        last_run = self.last_run()
+        last_full_sweep = self.last_full_sweep()
+        now = now or datetime.now()
+
+        if last_run is None or last_full_sweep is None:
+            return None
+
+        if now - last_full_sweep >= timedelta(days=full_sweep):
+            return None
+
+        return last_run
+
+    def save(self, started, full):
+        """
+        Record a successful run.
+
+        :param started: datetime.datetime the run started
+        :param full: whether the run was a full sweep
+        """
+        data = self._read()
+        entry = data.setdefault(self.job, {})
+        entry['last_run'] = started.strftime(self.DATE_FORMAT)
+
+        if full:
+            entry['last_full_sweep'] = started.strftime(self.DATE_FORMAT)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def indexed_documents(solr, query, fields, page_size=PAGE_SIZE, identifiers=None):
+    """
+    Iterate over the articles available in the search index, yielding
+    ``(solr_id, publisher_id, collection, doc)`` tuples, where ``doc`` holds
+    the exported ``fields``.
+
+    By default the articles are read straight from the streamed export of the
+    search index, the PID and the collection are parsed from the Solr id.
+    With ``identifiers``, an iterable of ``(publisher_id, collection)`` pairs
+    such as the ArticleMeta identifiers listing, only the listed articles
+    available in the search index are yielded.
+
+    :param solr: SolrAPI.Solr instance
+    :param query: Solr query string
+    :param fields: comma separated list of fields to export, besides the id
+    :param page_size: number of documents per request
+    :param identifiers: iterable of ``(publisher_id, collection)`` pairs
+    """
+    docs = export_docs(solr, query, 'id,%s' % fields, page_size)
+
+    if identifiers is None:
+        for doc in docs:
+            parsed = split_id(doc['id'])
+
+            if parsed is None:
+                continue
+
+            yield (doc['id'],) + parsed + (doc,)
+        return
+
+    available = dict((doc['id'], doc) for doc in docs)
+
+    for publisher_id, collection in identifiers:
+        solr_id = '-'.join([publisher_id, collection])
+
+        if solr_id in available:
+            yield solr_id, publisher_id, collection, available[solr_id]
+
+
+def lookup_documents(solr, query, fields, identifiers, chunk_size=LOOKUP_SIZE):
+    """
+    Iterate over the listed articles available in the search index, yielding
+    the same tuples as ``indexed_documents``.
+
+    The articles are looked up by their Solr ids, ``chunk_size`` ids per
+    request, so loading a few documents, such as the backfill queue, does not
+    read the whole index.
+
+    :param solr: SolrAPI.Solr instance
+    :param query: Solr query string
+    :param fields: comma separated list of fields to export, besides the id
+    :param identifiers: iterable of ``(publisher_id, collection)`` pairs
+    :param chunk_size: number of ids per request
+    """
+    identifiers = list(identifiers)
+
+    for start in range(0, len(identifiers), chunk_size):
+        chunk = identifiers[start:start + chunk_size]
+        solr_ids = ['-'.join(i) for i in chunk]
+
+        result = json.loads(solr.select({
+            'q': '(%s) AND id:(%s)' % (
+                query, ' OR '.join('"%s"' % i for i in solr_ids)),
+            'fl': 'id,%s' % fields,
+            'rows': len(chunk)
+        }))
+        available = dict((doc['id'], doc) for doc in result['response']['docs'])
+
+        for (publisher_id, collection), solr_id in zip(chunk, solr_ids):
+            if solr_id in available:
+                yield solr_id, publisher_id, collection, available[solr_id]
+
+
+class CitationsPrefetcher(object):
+    """
+    Look ahead in a stream of articles, fetching their received citations
+    concurrently before they reach the pipeline.
+
+    ``stream`` yields each article once its total of received citations is
+    fetched, with up to ``2 * concurrency`` articles in flight, and the
+    ``ReceivedCitations`` pipe reads the value with ``pop``.
+
+    When citedby fails, or ``breaker`` is open, the total is the last cached
+    value or None and the document is queued in ``backfill``.
+
+    :param concurrency: number of threads fetching citations
+    :param cache: updatesearch.cache.IndicatorsCache instance
+    :param breaker: updatesearch.workers.CircuitBreaker instance
+    :param backfill: BackfillQueue instance
+    """
+
+    def __init__(self, concurrency=PREFETCH_CONCURRENCY, cache=None,
+                 breaker=None, backfill=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.breaker = breaker
+        self.backfill = backfill
+        self.counts = {}
+        self.clients = ThreadLocalClient(citedby_client)
+
+    def received(self, publisher_id, collection):
+        try:
+            return cached(
+                self.cache, CITATIONS, publisher_id, collection,
+                lambda: guarded(
+                    self.breaker, received_citations, self.clients.get(),
+                    publisher_id)
+            )
+        except CircuitOpenError:
+            logger.debug("Circuit open, citations of %s not loaded." % publisher_id)
+        except Exception as e:
+            logger.error("Error: {0}".format(e))
+            logger.exception(e)
+
+        return fallback(
+            self.cache, self.backfill, CITATIONS, publisher_id, collection)
+
+    def fetch(self, article):
+        self.counts[article.publisher_id] = self.received(
+            article.publisher_id, article.collection_acronym)
+
+        return article
+
+    def stream(self, articles):
+        """
+        Prefetch the received citations of the articles.
+
+        :param articles: iterable of xylose.scielodocument.Article instances.
+        """
+        return imap_unordered(self.fetch, articles, workers=self.concurrency)
+
+    def pop(self, publisher_id, collection):
+        """
+        Return the total of citations received by a document, fetching it
+        now when it was not prefetched, or None when it is not available.
+        """
+        if publisher_id in self.counts:
+            return self.counts.pop(publisher_id)
+
+        return self.received(publisher_id, collection)
+
+
+def add_arguments(parser):
+    """
+    Add the circuit breaker and backfill options to an argparse parser.
+    """
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=CALL_TIMEOUT,
+        help='seconds each request to the indicators services may take, 0 disables it (default %d).' % CALL_TIMEOUT
+    )
+
+    parser.add_argument(
+        '--error_threshold',
+        type=float,
+        default=ERROR_THRESHOLD,
+        help='ratio of failed requests stopping the requests to an indicators service (default %.1f).' % ERROR_THRESHOLD
+    )
+
+    parser.add_argument(
+        '--breaker_window',
+        type=int,
+        default=BREAKER_WINDOW,
+        help='number of recent requests considered by --error_threshold (default %d).' % BREAKER_WINDOW
+    )
+
+    parser.add_argument(
+        '--breaker_reset',
+        type=int,
+        default=BREAKER_RESET,
+        help='seconds the requests stay stopped before probing the service again (default %d).' % BREAKER_RESET
+    )
+
+    parser.add_argument(
+        '--backfill',
+        default=BACKFILL_PATH,
+        help='file queuing the documents whose indicators could not be loaded, the processing try to get the variable from environment ``INDICATORS_BACKFILL`` (default no queue).'
+    )
+
+
+def breaker_from_arguments(args, name, concurrency=1):
+    """
+    Return the ``CircuitBreaker`` of an upstream configured by the options
+    added with ``add_arguments``.
+
+    :param concurrency: number of threads calling the upstream
+    """
+    return CircuitBreaker(
+        name,
+        timeout=args.timeout,
+        threshold=args.error_threshold,
+        window=args.breaker_window,
+        reset_timeout=args.breaker_reset,
+        concurrency=concurrency
+    )
+
+
+def backfill_from_arguments(args):
+    """
+    Return the ``BackfillQueue`` configured by the options added with
+    ``add_arguments`` or None when no file is given.
+    """
+    if not args.backfill:
+        return None
+
+    return BackfillQueue(args.backfill)
+
+
+def add_window_arguments(parser):
+    """
+    Add the incremental window options to an argparse parser.
+    """
+    parser.add_argument(
+        '-p', '--period',
+        type=int,
+        help='refresh the documents processed in a specific period, use number of days.'
+    )
+
+    parser.add_argument(
+        '-f', '--from_date',
+        type=lambda x: datetime.strptime(x, '%Y-%m-%d'),
+        nargs='?',
+        help='refresh the documents processed since this date. YYYY-MM-DD.'
+    )
+
+    parser.add_argument(
+        '--watermark',
+        default=WATERMARK_PATH,
+        help='file recording the last successful run, the next runs refresh only the documents processed since then, the processing try to get the variable from environment ``INDICATORS_WATERMARK`` (default no watermark).'
+    )
+
+    parser.add_argument(
+        '--full_sweep',
+        type=int,
+        default=FULL_SWEEP,
+        help='days between runs over every document when using --watermark (default %d).' % FULL_SWEEP
+    )
+
+
+def watermark_from_arguments(args, job):
+    """
+    Return the ``Watermark`` of a job configured by the options added with
+    ``add_window_arguments`` or None when no file is given. The runs are
+    recorded by ``--collection`` and ``--issn`` when the job has them.
+    """
+    if not args.watermark:
+        return None
+
+    return Watermark(
+        args.watermark, job, getattr(args, 'collection', None),
+        getattr(args, 'issn', None))
+
+
+def from_date_from_arguments(args, watermark=None):
+    """
+    Return the start of the window of documents to be refreshed, None for
+    every document.
+
+    An explicit ``--period`` or ``--from_date`` wins over the watermark.
+    """
+    if args.period:
+        return datetime.now() - timedelta(days=args.period)
+
+    if args.from_date:
+        return args.from_date
+
+    if watermark is not None:
+        return watermark.window_start(args.full_sweep)
+
+    return None
@@ -3,20 +3,29 @@
 import os
 import sys
 import time
-import json
 import argparse
 import logging
 import logging.config
 import textwrap
 import itertools
+import functools
 from datetime import datetime, timedelta
 
 from lxml import etree as ET
 from SolrAPI import Solr
 import plumber
-from articlemeta.client import ThriftClient
+from xylose.scielodocument import Article
 
 from updatesearch import pipeline_xml
+from updatesearch import clients
+from updatesearch.writer import BatchWriter, BATCH_SIZE, BATCH_BYTES, TIMEOUT
+from updatesearch.workers import (
+    ThreadLocalClient, StagedExecutor, SourceError, guard_source, imap_unordered)
+from updatesearch.export import build_query, export_docs, export_ids, PAGE_SIZE
+from updatesearch import indicators
+from updatesearch.indicators import CitationsPrefetcher, PREFETCH_CONCURRENCY
+from updatesearch import cache
+from updatesearch.differential import diff, sorted_stream, SORT_BUFFER, INCLUDE, UPDATE, REMOVE
 
 
 logger = logging.getLogger(__name__)
@@ -47,6 +56,10 @@ LOGGING = {
             'level': LOGGING_LEVEL,
             'propagate': False,
             },
+        'updatesearch': {
+            'level': LOGGING_LEVEL,
+            'propagate': True,
+        },
         'updatesearch.metadata': {
             'level': LOGGING_LEVEL,
             'propagate': True,
@@ -62,6 +75,52 @@ if SENTRY_HANDLER:
     }
     LOGGING['loggers']['']['handlers'].append('sentry')
 
+TRANSFORM_CHUNK_SIZE = 100
+
+_transformers = {}
+
+
+def _transform_chunk(load_indicators, chunk):
+    """
+    Transform a chunk of raw ArticleMeta documents in serialized ``<doc>``
+    elements.
+
+    Runs in the worker processes of ``UpdateSearch.transform_stream``, each
+    worker builds its own pipeline when it receives the first chunk.
+
+    :param chunk: list of ``(raw, total_received)`` pairs, where
+    ``total_received`` is the prefetched total of received citations, None
+    when it is not available.
+
+    :returns: ``(docs, hits, misses)`` where ``hits`` and ``misses`` are the
+    journal cache hits and misses of the chunk
+    """
+    us = _transformers.get(load_indicators)
+
+    if us is None:
+        us = _transformers[load_indicators] = UpdateSearch(
+            load_indicators=load_indicators)
+
+    hits, misses = us.journal_cache.hits, us.journal_cache.misses
+
+    articles = []
+    for raw, total_received in chunk:
+        article = Article(raw)
+        if us.citations is not None:
+            us.citations.counts[article.publisher_id] = total_received
+        articles.append(article)
+
+    docs = [
+        ET.tostring(xml, encoding="utf-8", method="xml")
+        for xml in us.pipeline_stream(articles)
+    ]
+
+    return (
+        docs,
+        us.journal_cache.hits - hits,
+        us.journal_cache.misses - misses
+    )
+
 
 class UpdateSearch(object):
     """
@@ -70,7 +129,12 @@ class UpdateSearch(object):
 
     def __init__(self, period=None, from_date=None, until_date=None,
                  collection=None, issn=None, delete=False, differential=False,
-                 load_indicators=False):
+                 load_indicators=False, batch_size=BATCH_SIZE,
+                 batch_bytes=BATCH_BYTES, workers=1, page_size=PAGE_SIZE,
+                 sort_buffer=SORT_BUFFER, processes=1,
+                 queue_depth=0, indicators_concurrency=PREFETCH_CONCURRENCY,
+                 indicators_cache=None, indicators_breaker=None,
+                 indicators_backfill=None):
         self.delete = delete
         self.collection = collection
         self.from_date = from_date
@@ -78,7 +142,21 @@ class UpdateSearch(object):
         self.differential = differential
         self.load_indicators = load_indicators
         self.issn = issn
-        self.solr = Solr(SOLR_URL, timeout=10)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.workers = workers
+        self.page_size = page_size
+        self.sort_buffer = sort_buffer
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self._pipeline = None
+        self.journal_cache = pipeline_xml.JournalCache()
+        self.citations = None
+        if load_indicators:
+            self.citations = CitationsPrefetcher(
+                indicators_concurrency, indicators_cache, indicators_breaker,
+                indicators_backfill)
+        self.solr = Solr(SOLR_URL, timeout=TIMEOUT)
         if period:
             self.from_date = datetime.now() - timedelta(days=period)
 
@@ -95,11 +173,12 @@ class UpdateSearch(object):
 
         return date.strftime('%Y-%m-%d')
 
-    def pipeline_to_xml(self, article):
+    def build_pipeline(self):
         """
-        Pipeline to tranform a dictionary to XML format
+        Build the pipeline to tranform articles in ``<doc>`` elements.
 
-        :param list_dict: List of dictionary content key tronsform in a XML.
+        The pipes are stateless, so the same pipeline is reused for every
+        article of the run.
         """
 
         pipeline_itens = [
@@ -114,9 +193,9 @@ class UpdateSearch(object):
             pipeline_xml.Titles(),
             pipeline_xml.OriginalTitle(),
             pipeline_xml.Pages(),
-            pipeline_xml.WOKCI(),
-            pipeline_xml.WOKSC(),
-            pipeline_xml.JournalAbbrevTitle(),
+            pipeline_xml.WOKCI(self.journal_cache),
+            pipeline_xml.WOKSC(self.journal_cache),
+            pipeline_xml.JournalAbbrevTitle(self.journal_cache),
             pipeline_xml.Languages(),
             pipeline_xml.AvailableLanguages(),
             pipeline_xml.Fulltexts(),
@@ -134,143 +213,263 @@ class UpdateSearch(object):
             pipeline_xml.ElocationPage(),
             pipeline_xml.StartPage(),
             pipeline_xml.EndPage(),
-            pipeline_xml.JournalTitle(),
+            pipeline_xml.JournalTitle(self.journal_cache),
             pipeline_xml.IsCitable(),
             pipeline_xml.Permission(),
             pipeline_xml.Keywords(),
-            pipeline_xml.JournalISSNs(),
-            pipeline_xml.SubjectAreas()
+            pipeline_xml.JournalISSNs(self.journal_cache),
+            pipeline_xml.SubjectAreas(self.journal_cache)
         ]
 
         if self.load_indicators is True:
-            pipeline_itens.append(pipeline_xml.ReceivedCitations())
+            pipeline_itens.append(pipeline_xml.ReceivedCitations(self.citations))
 
         pipeline_itens.append(pipeline_xml.TearDown())
 
-        ppl = plumber.Pipeline(*pipeline_itens)
+        return plumber.Pipeline(*pipeline_itens)
+
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self.build_pipeline()
+
+        return self._pipeline
+
+    def pipeline_to_docs(self, article):
+        """
+        Pipeline to tranform an article in a list of ``<doc>`` elements.
+
+        :param article: xylose.scielodocument.Article instance.
+        """
+
+        return list(self.pipeline.run([article]))
+
+    def pipeline_stream(self, articles):
+        """
+        Run the pipeline over an iterable of articles yielding lazily one
+        ``<doc>`` element per article.
+
+        Articles that fail to be transformed are logged and skipped, the
+        pipeline is resumed from the next article of the iterable. Errors
+        raised by the iterable itself are raised.
+
+        :param articles: iterable of xylose.scielodocument.Article instances.
+        """
+        articles = guard_source(articles)
+
+        while True:
+            try:
+                for xml in self.pipeline.run(articles):
+                    yield xml
+                return
+            except SourceError as e:
+                raise e.error
+            except Exception as e:
+                logger.error("Error: {0}".format(e))
+                logger.exception(e)
+
+    def transform_stream(self, articles):
+        """
+        Transform the articles in ``<doc>`` elements.
+
+        With ``self.processes`` greater than one, the raw JSON of the articles
+        is sent in chunks to a pool of worker processes, which return the
+        serialized ``<doc>`` elements in order of completion.
 
-        xmls = ppl.run([article])
+        :param articles: iterable of xylose.scielodocument.Article instances.
+        """
+        if self.processes <= 1:
+            for xml in self.pipeline_stream(articles):
+                yield xml
+            return
+
+        counts = self.citations.counts if self.citations is not None else {}
+        articles = iter(articles)
+        chunks = iter(lambda: [
+            (article.data, counts.pop(article.publisher_id, None))
+            for article in itertools.islice(articles, TRANSFORM_CHUNK_SIZE)], [])
+
+        results = imap_unordered(
+            functools.partial(_transform_chunk, self.load_indicators),
+            chunks,
+            workers=self.processes,
+            processes=True
+        )
+
+        for docs, hits, misses in results:
+            # the journal caches live in the worker processes
+            self.journal_cache.hits += hits
+            self.journal_cache.misses += misses
+
+            for xml in docs:
+                yield xml
+
+    def index(self, articles, writer):
+        """
+        Transform the articles and send them to the search index.
+
+        With ``self.queue_depth`` the articles are fetched, transformed and
+        written by pipelined stages connected by queues of that size. With
+        ``self.load_indicators`` the received citations are prefetched while
+        the articles are fetched.
+
+        :param articles: iterable of xylose.scielodocument.Article instances.
+        :param writer: updatesearch.writer.BatchWriter instance.
+        """
+        fetch = iter
+        if self.citations is not None:
+            fetch = self.citations.stream
+
+        if not self.queue_depth:
+            for xml in self.transform_stream(fetch(articles)):
+                writer.add(xml)
+            return
+
+        StagedExecutor([
+            ('fetch', fetch),
+            ('transform', self.transform_stream),
+            ('write', writer.add_stream)
+        ], self.queue_depth).run(articles)
+
+    def pipeline_to_xml(self, article):
+        """
+        Pipeline to tranform a dictionary to XML format
+
+        :param list_dict: List of dictionary content key tronsform in a XML.
+        """
 
         # Add root document
         add = ET.Element('add')
 
-        for xml in xmls:
+        for xml in self.pipeline_to_docs(article):
             add.append(xml)
 
         return ET.tostring(add, encoding="utf-8", method="xml")
 
-    def differential_mode(self):
-        art_meta = ThriftClient()
+    def include_documents(self, include_ids):
+        """
+        Fetch from ArticleMeta the documents to be included in the search
+        index.
 
-        logger.info("Running with differential mode")
-        ind_ids = set()
-        art_ids = set()
+        The documents are fetched by a pool of ``self.workers`` threads, each
+        one with its own ArticleMeta client, and are yielded in order of
+        completion.
 
-        # all ids in search index
-        logger.info("Loading Search Index ids.")
-        itens_query = []
-        if self.collection:
-            itens_query.append('in:%s' % self.collection)
+        :param include_ids: iterable of ``pid-collection`` ids.
+        """
+        art_meta_clients = ThreadLocalClient(clients.articlemeta_client)
+
+        def fetch(item):
+            ndx, to_include_id = item
+            logger.debug("Including (%d): %s" % (ndx, to_include_id))
+            code, collection = to_include_id.rsplit('-', 1)
+            try:
+                return art_meta_clients.get().document(code=code, collection=collection)
+            except Exception as e:
+                logger.error("Error: {0}".format(e))
+                logger.exception(e)
 
-        if self.issn:
-            itens_query.append('issn:%s' % self.issn)
+        documents = imap_unordered(
+            fetch, enumerate(include_ids, 1), workers=self.workers)
 
-        query = '*:*' if len(itens_query) == 0 else ' AND '.join(itens_query)
-        list_ids = json.loads(self.solr.select(
-            {'q': query, 'fl': 'id,scielo_processing_date', 'rows': 1000000}))['response']['docs']
+        for document in documents:
+            if document is not None:
+                yield document
 
-        for id in list_ids:
-            ind_ids.add('%s-%s' % (id['id'], id.get('scielo_processing_date', '1900-01-01')))
+    def differential_ids(self, art_meta, writer):
+        """
+        Compare the ids available in the search index with the ids available
+        in ArticleMeta, yielding the ids to be included or updated.
+
+        Both sides are read as streams sorted by id and compared in a single
+        merge pass, the ArticleMeta ids are sorted locally spilling to disk
+        when they do not fit in ``self.sort_buffer``. When ``self.delete`` is
+        set, the ids not available in ArticleMeta are removed from the search
+        index during the same pass.
 
-        # all ids in articlemeta
+        :param art_meta: articlemeta.client.ThriftClient instance.
+        :param writer: updatesearch.writer.BatchWriter instance.
+        """
         logger.info("Loading ArticleMeta ids.")
-        for item in art_meta.documents(
-            collection=self.collection,
-            issn=self.issn,
-            only_identifiers=True
-        ):
-            art_ids.add('%s-%s-%s' % (item.code, item.collection, item.processing_date))
+        source_items = sorted_stream((
+            ('%s-%s' % (item.code, item.collection), item.processing_date)
+            for item in art_meta.documents(
+                collection=self.collection,
+                issn=self.issn,
+                only_identifiers=True
+            )
+        ), self.sort_buffer)
 
-        # Ids to remove
-        if self.delete is True:
-            logger.info("Running remove records process.")
-            remove_ids = set([i[:27] for i in ind_ids]) - set([i[:27] for i in art_ids])
-            logger.info("Removing (%d) documents from search index." % len(remove_ids))
-            total_to_remove = len(remove_ids)
-            if total_to_remove > 0:
-                for ndx, to_remove_id in enumerate(remove_ids, 1):
-                    logger.debug("Removing (%d/%d): %s" % (ndx, total_to_remove, to_remove_id))
-                    self.solr.delete('id:%s' % to_remove_id, commit=False)
-
-        # Ids to include
-        logger.info("Running include records process.")
-        include_ids = art_ids - ind_ids
-        logger.info("Including (%d) documents to search index." % len(include_ids))
-        total_to_include = len(include_ids)
-        if total_to_include > 0:
-            for ndx, to_include_id in enumerate(include_ids, 1):
-                logger.debug("Including (%d/%d): %s" % (ndx, total_to_include, to_include_id))
-                code = to_include_id[:23]
-                collection = to_include_id[24: 27]
-                processing_date = to_include_id[:-11]
-                document = art_meta.document(code=code, collection=collection)
-                try:
-                    xml = self.pipeline_to_xml(document)
-                    self.solr.update(xml, commit=False)
-                except ValueError as e:
-                    logger.error("ValueError: {0}".format(e))
-                    logger.exception(e)
-                    continue
-                except Exception as e:
-                    logger.error("Error: {0}".format(e))
-                    logger.exception(e)
-                    continue
-
-    def common_mode(self):
-        art_meta = ThriftClient()
+        logger.info("Loading Search Index ids.")
+        query = build_query(self.collection, self.issn)
+        index_items = (
+            (i['id'], i.get('scielo_processing_date', '1900-01-01'))
+            for i in export_docs(
+                self.solr, query, 'id,scielo_processing_date', self.page_size)
+        )
+
+        totals = {INCLUDE: 0, UPDATE: 0, REMOVE: 0}
+
+        for action, id, processing_date in diff(index_items, source_items):
+            totals[action] += 1
+
+            if action == REMOVE:
+                if self.delete is True:
+                    logger.debug("Removing: %s" % id)
+                    writer.delete(id)
+                continue
+
+            yield id
+
+        logger.info(
+            "Differential: (%d) included, (%d) updated, (%d) %s." % (
+                totals[INCLUDE], totals[UPDATE], totals[REMOVE],
+                'removed' if self.delete is True else 'only in search index'
+            )
+        )
+
+    def log_documents(self, documents):
+        """
+        Log each document of the iterable while it is consumed by the
+        pipeline.
+        """
+        for document in documents:
+            logger.debug("Loading document %s" % '_'.join([document.collection_acronym, document.publisher_id]))
+            yield document
+
+    def differential_mode(self, writer):
+        art_meta = clients.get(clients.ARTICLEMETA)
+
+        logger.info("Running with differential mode")
+
+        self.index(
+            self.include_documents(self.differential_ids(art_meta, writer)),
+            writer
+        )
+
+    def common_mode(self, writer):
+        art_meta = clients.get(clients.ARTICLEMETA)
 
         logger.info("Running without differential mode")
         logger.info("Indexing in {0}".format(self.solr.url))
-        for document in art_meta.documents(
+        documents = art_meta.documents(
             collection=self.collection,
             issn=self.issn,
             from_date=self.format_date(self.from_date),
             until_date=self.format_date(self.until_date)
-        ):
-
-            logger.debug("Loading document %s" % '_'.join([document.collection_acronym, document.publisher_id]))
+        )
 
-            try:
-                xml = self.pipeline_to_xml(document)
-                self.solr.update(xml, commit=False)
-            except ValueError as e:
-                logger.error("ValueError: {0}".format(e))
-                logger.exception(e)
-                continue
-            except Exception as e:
-                logger.error("Error: {0}".format(e))
-                logger.exception(e)
-                continue
+        self.index(self.log_documents(documents), writer)
 
         if self.delete is True:
             logger.info("Running remove records process.")
             ind_ids = set()
             art_ids = set()
 
-            itens_query = []
-            if self.collection:
-                itens_query.append('in:%s' % self.collection)
-
-            if self.issn:
-                itens_query.append('issn:%s' % self.issn)
-
-            query = '*:*' if len(itens_query) == 0 else ' AND '.join(itens_query)
-
-            list_ids = json.loads(self.solr.select(
-                {'q': query, 'fl': 'id', 'rows': 1000000}))['response']['docs']
+            query = build_query(self.collection, self.issn)
 
-            for id in list_ids:
-                ind_ids.add(id['id'])
+            for id in export_ids(self.solr, query, self.page_size):
+                ind_ids.add(id)
 
             # all ids in articlemeta
             for item in art_meta.documents(
@@ -280,21 +479,29 @@ class UpdateSearch(object):
             ):
                 art_ids.add('%s-%s' % (item.code, item.collection))
             # Ids to remove
+            remove_ids = ind_ids - art_ids
             total_to_remove = len(remove_ids)
             logger.info("Removing (%d) documents from search index." % len(remove_ids))
-            remove_ids = ind_ids - art_ids
             for ndx, to_remove_id in enumerate(remove_ids, 1):
                 logger.debug("Removing (%d/%d): %s" % (ndx, total_to_remove, to_remove_id))
-                self.solr.delete('id:%s' % to_remove_id, commit=False)
+                writer.delete(to_remove_id)
 
     def run(self):
         """
         Run the process for update article in Solr.
         """
-        if self.differential is True:
-            self.differential_mode()
+        with BatchWriter(self.solr, self.batch_size, self.batch_bytes) as writer:
+            if self.differential is True:
+                self.differential_mode(writer)
+            else:
+                self.common_mode(writer)
+
+        if self.processes > 1:
+            logger.info("Journal cache: (%d) hits, (%d) misses in (%d) processes." % (
+                self.journal_cache.hits, self.journal_cache.misses, self.processes))
         else:
-            self.common_mode()
+            logger.info("Journal cache: (%d) hits, (%d) misses, (%d) journals." % (
+                self.journal_cache.hits, self.journal_cache.misses, len(self.journal_cache)))
 
         # optimize the index
         self.solr.commit()
@@ -339,7 +546,14 @@ def main():
         '-n', '--load_indicators',
         default=False,
         action='store_true',
-        help='Load articles received citations and downloads while including or updating documents. It makes the processing extremelly slow.'
+        help='Load articles received citations while including or updating documents. The citations are prefetched concurrently, see --indicators_concurrency.'
+    )
+
+    parser.add_argument(
+        '--indicators_concurrency',
+        type=int,
+        default=PREFETCH_CONCURRENCY,
+        help='number of concurrent requests prefetching the received citations with --load_indicators (default %d).' % PREFETCH_CONCURRENCY
     )
 
     parser.add_argument(
@@ -350,6 +564,9 @@ def main():
         default=datetime.now()
     )
 
+    cache.add_arguments(parser)
+    indicators.add_arguments(parser)
+
     parser.add_argument(
         '-c', '--collection',
         default=None,
@@ -369,6 +586,55 @@ def main():
         help='delete query ex.: q=*:* (Lucene Syntax).'
     )
 
+    parser.add_argument(
+        '-b', '--batch_size',
+        type=int,
+        default=BATCH_SIZE,
+        help='number of documents sent to Solr per request (default %d).' % BATCH_SIZE
+    )
+
+    parser.add_argument(
+        '--batch_bytes',
+        type=int,
+        default=BATCH_BYTES,
+        help='maximum size in bytes of the documents sent to Solr per request (default %d).' % BATCH_BYTES
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of threads fetching documents from ArticleMeta in differential mode (default 1).'
+    )
+
+    parser.add_argument(
+        '--page_size',
+        type=int,
+        default=PAGE_SIZE,
+        help='number of ids read from Solr per request (default %d).' % PAGE_SIZE
+    )
+
+    parser.add_argument(
+        '--sort_buffer',
+        type=int,
+        default=SORT_BUFFER,
+        help='number of ArticleMeta ids sorted in memory in differential mode, bigger listings are sorted spilling to disk (default %d).' % SORT_BUFFER
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='number of processes transforming documents (default 1).'
+    )
+
+    parser.add_argument(
+        '-q', '--queue_depth',
+        type=int,
+        default=0,
+        help='run fetch, transform and Solr writes as pipelined stages connected by queues of this size, 0 runs them sequentially (default 0).'
+    )
+
     parser.add_argument(
         '--logging_level',
         '-l',
@@ -385,6 +651,7 @@ def main():
     logging.config.dictConfig(LOGGING)
 
     start = time.time()
+    indicators_cache = cache.from_arguments(args)
 
     try:
         us = UpdateSearch(
@@ -395,12 +662,27 @@ def main():
             issn=args.issn,
             delete=args.delete,
             differential=args.differential,
-            load_indicators=args.load_indicators
+            load_indicators=args.load_indicators,
+            batch_size=args.batch_size,
+            batch_bytes=args.batch_bytes,
+            workers=args.workers,
+            page_size=args.page_size,
+            sort_buffer=args.sort_buffer,
+            processes=args.processes,
+            queue_depth=args.queue_depth,
+            indicators_concurrency=args.indicators_concurrency,
+            indicators_cache=indicators_cache,
+            indicators_breaker=indicators.breaker_from_arguments(
+                args, clients.CITEDBY, args.indicators_concurrency),
+            indicators_backfill=indicators.backfill_from_arguments(args)
         )
         us.run()
     except KeyboardInterrupt:
         logger.critical("Interrupt by user")
     finally:
+        if indicators_cache is not None:
+            indicators_cache.close()
+
         # End Time
         end = time.time()
         logger.info("Duration {0} seconds.".format(end-start))
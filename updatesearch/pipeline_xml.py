@@ -1,11 +1,14 @@
 # coding: utf-8
+import copy
+from collections import OrderedDict
+
 from lxml import etree as ET
 
 import plumber
-from citedby import client
 
+from updatesearch import clients
+from updatesearch.indicators import received_citations
 
-CITEDBY = client.ThriftClient(domain='citedby.scielo.org:11610')
 
 """
 Full example output of this pipeline:
@@ -51,44 +54,162 @@ CITABLE_DOCUMENT_TYPES = (
     u'review-article'
 )
 
+JOURNAL_CACHE_SIZE = 2000
+
+
+class JournalCache(object):
+    """
+    Cache of the fields derived from the journal metadata, keyed by the
+    collection and the journal ``scielo_issn``, since the same journal is
+    published in several collections with its own metadata in each one.
+
+    A journal usually has thousands of articles, so the fields are built once
+    per journal and cloned into each document. The least recently used
+    journals are evicted when more than ``maxsize`` journals are cached.
+
+    :param maxsize: maximum number of cached journals
+    """
+
+    def __init__(self, maxsize=JOURNAL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._journals = OrderedDict()
+
+    def __len__(self):
+        return len(self._journals)
+
+    def fields(self, raw, name, builder):
+        """
+        Return copies of the fields ``name`` of the journal of ``raw``,
+        calling ``builder(raw)`` when they are not cached yet.
+        """
+        key = (raw.collection_acronym, raw.journal.scielo_issn)
+
+        journal = self._journals.get(key)
+        if journal is None:
+            journal = self._journals[key] = {}
+            if len(self._journals) > self.maxsize:
+                self._journals.popitem(last=False)
+        else:
+            self._journals.move_to_end(key)
+
+        if name in journal:
+            self.hits += 1
+        else:
+            self.misses += 1
+            journal[name] = builder(raw)
+
+        return [copy.deepcopy(field) for field in journal[name]]
+
+
+class JournalPipe(plumber.Pipe):
+    """
+    Pipe adding fields that depend only on the journal of the document.
+
+    Subclasses build the fields in ``fields``. When a ``JournalCache`` is
+    given they are built once per journal.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def fields(self, raw):
+        raise NotImplementedError()
+
+    def transform(self, data):
+        raw, xml = data
+
+        if self.cache is None:
+            fields = self.fields(raw)
+        else:
+            fields = self.cache.fields(raw, self.__class__.__name__, self.fields)
+
+        for field in fields:
+            xml.find('.').append(field)
+
+        return data
+
+
+class MemoizedArticle(object):
+    """
+    Proxy to a xylose ``Article`` computing each accessor at most once.
+
+    Many pipes read the same attributes and call the same methods of the
+    document (``original_title()``, ``translated_abstracts()``,
+    ``languages()``, ``fulltexts()``, ...), each call parsing the underlying
+    ISIS-like JSON again. The proxy keeps the first result of every property
+    and of every method call, by arguments, for the lifetime of the document.
+
+    :param article: xylose.scielodocument.Article instance
+    """
+
+    def __init__(self, article):
+        self.__dict__['_article'] = article
+
+    def __getattr__(self, name):
+        value = getattr(self._article, name)
+
+        if callable(value):
+            value = self._memoize(value)
+
+        self.__dict__[name] = value
+
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._article, name, value)
+        self.__dict__.pop(name, None)
+
+    @staticmethod
+    def _memoize(method):
+        results = {}
+
+        def memoized(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+
+            if key not in results:
+                results[key] = method(*args, **kwargs)
+
+            return results[key]
+
+        return memoized
+
 
 class SetupDocument(plumber.Pipe):
 
     def transform(self, data):
         xml = ET.Element('doc')
 
-        return data, xml
+        if not isinstance(data, MemoizedArticle):
+            data = MemoizedArticle(data)
 
+        return data, xml
 
-class SubjectAreas(plumber.Pipe):
 
-    def precond(data):
-        raw, xml = data
+class SubjectAreas(JournalPipe):
 
+    def fields(self, raw):
         if not raw.journal.subject_areas:
-            raise plumber.UnmetPrecondition()
-
-    @plumber.precondition(precond)
-    def transform(self, data):
-        raw, xml = data
+            return []
 
         if len(raw.journal.subject_areas) > 2:
 
             field = ET.Element('field')
             field.text = 'multidisciplinary'
             field.set('name', 'subject_area')
-            xml.find('.').append(field)
 
-            return data
+            return [field]
 
+        fields = []
         for subject_area in raw.journal.subject_areas:
             field = ET.Element('field')
             field.text = subject_area
             field.set('name', 'subject_area')
 
-            xml.find('.').append(field)
+            fields.append(field)
 
-        return data
+        return fields
 
 
 class Keywords(plumber.Pipe):
@@ -128,11 +249,9 @@ class IsCitable(plumber.Pipe):
         return data
 
 
-class JournalISSNs(plumber.Pipe):
-
-    def transform(self, data):
-        raw, xml = data
+class JournalISSNs(JournalPipe):
 
+    def fields(self, raw):
         issns = set()
         if raw.electronic_issn:
             issns.add(raw.journal.electronic_issn)
@@ -142,14 +261,15 @@ class JournalISSNs(plumber.Pipe):
 
         issns.add(raw.journal.scielo_issn)
 
+        fields = []
         for issn in issns:
             field = ET.Element('field')
             field.text = issn
             field.set('name', 'issn')
 
-            xml.find('.').append(field)
+            fields.append(field)
 
-        return data
+        return fields
 
 
 class DocumentID(plumber.Pipe):
@@ -166,32 +286,14 @@ class DocumentID(plumber.Pipe):
         return data
 
 
-class JournalTitle(plumber.Pipe):
-
-    def transform(self, data):
-        raw, xml = data
-
-        field = ET.Element('field')
-        field.text = raw.journal.title
-        field.set('name', 'journal_title')
-
-        xml.find('.').append(field)
-
-        return data
-
-
-class JournalTitle(plumber.Pipe):
-
-    def transform(self, data):
-        raw, xml = data
+class JournalTitle(JournalPipe):
 
+    def fields(self, raw):
         field = ET.Element('field')
         field.text = raw.journal.title
         field.set('name', 'journal_title')
 
-        xml.find('.').append(field)
-
-        return data
+        return [field]
 
 
 class Permission(plumber.Pipe):
@@ -421,46 +523,32 @@ class DOI(plumber.Pipe):
         return data
 
 
-class WOKCI(plumber.Pipe):
-
-    def precond(data):
-        raw, xml = data
-
-        if not raw.journal.wos_citation_indexes:
-            raise plumber.UnmetPrecondition()
+class WOKCI(JournalPipe):
 
-    @plumber.precondition(precond)
-    def transform(self, data):
-        raw, xml = data
+    def fields(self, raw):
+        fields = []
 
-        for index in raw.journal.wos_citation_indexes:
+        for index in raw.journal.wos_citation_indexes or []:
             field = ET.Element('field')
             field.text = index.replace('&', '')
             field.set('name', 'wok_citation_index')
-            xml.find('.').append(field)
+            fields.append(field)
 
-        return data
-
-
-class WOKSC(plumber.Pipe):
+        return fields
 
-    def precond(data):
-        raw, xml = data
 
-        if not raw.journal.wos_subject_areas:
-            raise plumber.UnmetPrecondition()
+class WOKSC(JournalPipe):
 
-    @plumber.precondition(precond)
-    def transform(self, data):
-        raw, xml = data
+    def fields(self, raw):
+        fields = []
 
-        for index in raw.journal.wos_subject_areas:
+        for index in raw.journal.wos_subject_areas or []:
             field = ET.Element('field')
             field.text = index
             field.set('name', 'wok_subject_categories')
-            xml.find('.').append(field)
+            fields.append(field)
 
-        return data
+        return fields
 
 
 class Volume(plumber.Pipe):
@@ -582,17 +670,14 @@ class EndPage(plumber.Pipe):
         return data
 
 
-class JournalAbbrevTitle(plumber.Pipe):
-
-    def transform(self, data):
-        raw, xml = data
+class JournalAbbrevTitle(JournalPipe):
 
+    def fields(self, raw):
         field = ET.Element('field')
         field.text = raw.journal.abbreviated_title
         field.set('name', 'ta')
-        xml.find('.').append(field)
 
-        return data
+        return [field]
 
 
 class Languages(plumber.Pipe):
@@ -693,14 +778,31 @@ class SciELOPublicationDate(plumber.Pipe):
 
 
 class ReceivedCitations(plumber.Pipe):
+    """
+    Reads the received citations from a
+    ``updatesearch.indicators.CitationsPrefetcher`` when it is given,
+    otherwise asks citedby for each document. The field is left out when the
+    total is not available.
+    """
+
+    def __init__(self, prefetcher=None):
+        self.prefetcher = prefetcher
 
     def transform(self, data):
         raw, xml = data
 
-        result = CITEDBY.citedby_pid(raw.publisher_id, metaonly=True)
+        if self.prefetcher is not None:
+            total_received = self.prefetcher.pop(
+                raw.publisher_id, raw.collection_acronym)
+        else:
+            total_received = received_citations(
+                clients.get(clients.CITEDBY), raw.publisher_id)
+
+        if total_received is None:
+            return data
 
         field = ET.Element('field')
-        field.text = str(result.get('article', {'total_received': 0})['total_received'])
+        field.text = str(total_received)
         field.set('name', 'total_received')
         xml.find('.').append(field)
 
@@ -0,0 +1,488 @@
+#!/usr/bin/python
+# coding: utf-8
+import os
+import time
+import argparse
+import logging
+import logging.config
+import textwrap
+from datetime import datetime, timedelta
+
+from lxml import etree as ET
+from SolrAPI import Solr
+
+from updatesearch.export import build_query, PAGE_SIZE
+from updatesearch import indicators
+from updatesearch.indicators import (
+    access_total, received_citations, indexed_documents, lookup_documents,
+    guarded, SOURCES)
+from updatesearch import cache
+from updatesearch import clients
+from updatesearch.clients import citedby_client, accessstats_client
+from updatesearch.cache import cached, ACCESSES, CITATIONS
+from updatesearch.workers import (
+    ThreadLocalClient, RateLimiter, CircuitOpenError, imap_unordered)
+from updatesearch.writer import BatchWriter, BATCH_SIZE, BATCH_BYTES, FLUSH_INTERVAL, TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+SOLR_URL = os.environ.get('SOLR_URL', 'http://127.0.0.1/solr')
+SENTRY_HANDLER = os.environ.get('SENTRY_HANDLER', None)
+LOGGING_LEVEL = os.environ.get('LOGGING_LEVEL', 'DEBUG')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': True,
+
+    'formatters': {
+        'console': {
+            'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            'datefmt': '%H:%M:%S',
+            },
+        },
+    'handlers': {
+        'console': {
+            'level': LOGGING_LEVEL,
+            'class': 'logging.StreamHandler',
+            'formatter': 'console'
+            }
+        },
+    'loggers': {
+        '': {
+            'handlers': ['console'],
+            'level': LOGGING_LEVEL,
+            'propagate': False,
+            },
+        'updatesearch': {
+            'level': LOGGING_LEVEL,
+            'propagate': True,
+        },
+        'updatesearch.totals': {
+            'level': LOGGING_LEVEL,
+            'propagate': True,
+        },
+    }
+}
+
+if SENTRY_HANDLER:
+    LOGGING['handlers']['sentry'] = {
+        'level': 'ERROR',
+        'class': 'raven.handlers.logging.SentryHandler',
+        'dsn': SENTRY_HANDLER,
+    }
+    LOGGING['loggers']['']['handlers'].append('sentry')
+
+FIELDS = {
+    ACCESSES: 'total_access',
+    CITATIONS: 'total_received'
+}
+
+INDICATORS = (ACCESSES, CITATIONS)
+
+SERVICES = {
+    ACCESSES: clients.RATCHET,
+    CITATIONS: clients.CITEDBY
+}
+
+USAGE = """\
+    Process to load accesses and citations counts to documents in SciELO Solr.
+
+    This process collects articles accesses and citations in a single pass
+    and store them in SciELO Solr.
+    """
+
+
+class UpdateSearch(object):
+    """
+    Process to load the accesses and the received citations of the indexed
+    documents in a single pass.
+
+    Both counts of a document are fetched concurrently, each upstream with its
+    own rate limiter and circuit breaker, and both fields are set by a single
+    atomic update. With ``indicators`` only the given counts are loaded, as
+    by the ``update_search_accesses`` and ``update_search_citations`` jobs.
+    """
+
+    def __init__(self, collection=None, issn=None, page_size=PAGE_SIZE,
+                 indicators_cache=None, source='solr', workers=1,
+                 accesses_rate=0, accesses_max_in_flight=0, citations_rate=0,
+                 citations_max_in_flight=0, batch_size=BATCH_SIZE,
+                 batch_bytes=BATCH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 breakers=None, backfill=None, period=None, from_date=None,
+                 indicators=INDICATORS):
+        self.indicators = tuple(indicators)
+        self.fields = dict((i, FIELDS[i]) for i in self.indicators)
+        self.collection = collection
+        self.issn = issn
+        self.page_size = page_size
+        self.indicators_cache = indicators_cache
+        self.source = source
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.breakers = breakers or {}
+        self.backfill = backfill
+        self.failures = 0
+        self.dropped = 0
+        self.from_date = from_date
+        if period:
+            self.from_date = datetime.now() - timedelta(days=period)
+        self.limiters = {
+            ACCESSES: RateLimiter(accesses_rate, accesses_max_in_flight),
+            CITATIONS: RateLimiter(citations_rate, citations_max_in_flight)
+        }
+        self.clients = {
+            ACCESSES: ThreadLocalClient(accessstats_client),
+            CITATIONS: ThreadLocalClient(citedby_client)
+        }
+        self.solr = Solr(SOLR_URL, timeout=TIMEOUT)
+
+    def set_indicators(self, document_id, totals):
+        """
+        Build the ``<doc>`` atomic update setting the given indicators of a
+        document.
+
+        :param totals: dict of the indicators values by Solr field
+        """
+        doc = ET.Element('doc')
+
+        identifier = ET.Element('field')
+        identifier.set('name', 'id')
+        identifier.text = document_id
+        doc.append(identifier)
+
+        for name, value in sorted(totals.items()):
+            field = ET.Element('field')
+            field.set('name', name)
+            field.text = str(value)
+            field.set('update', 'set')
+            doc.append(field)
+
+        return doc
+
+    def request(self, indicator, publisher_id, collection):
+        client = self.clients[indicator].get()
+        breaker = self.breakers.get(indicator)
+        limiter = self.limiters[indicator]
+
+        if indicator == ACCESSES:
+            return guarded(
+                breaker, access_total, client, publisher_id, collection,
+                limiter=limiter)
+
+        return guarded(
+            breaker, received_citations, client, publisher_id, limiter=limiter)
+
+    def tasks(self, documents):
+        """
+        Split each document in one task per indicator, so both counts are
+        fetched at the same time by the workers.
+        """
+        for item in documents:
+            for indicator in self.indicators:
+                yield indicator, item
+
+    def fetch(self, task):
+        """
+        Fetch an indicator of a document, returning
+        ``(indicator, solr_id, doc, total)``, total is None when the request
+        fails or the circuit is open, and the document is queued in
+        ``self.backfill``.
+
+        Runs in the worker threads, each one with its own clients.
+        """
+        indicator, (solr_id, publisher_id, collection, doc) = task
+
+        logger.debug("Loading %s for document %s" % (indicator, solr_id))
+
+        try:
+            total = cached(
+                self.indicators_cache,
+                indicator,
+                publisher_id,
+                collection,
+                lambda: self.request(indicator, publisher_id, collection)
+            )
+        except CircuitOpenError:
+            logger.debug("Circuit open, %s of %s not loaded." % (indicator, solr_id))
+        except Exception as e:
+            logger.error("Error: {0}".format(e))
+            logger.exception(e)
+        else:
+            return indicator, solr_id, doc, total
+
+        if self.backfill is not None:
+            self.backfill.add(indicator, publisher_id, collection)
+
+        return indicator, solr_id, doc, None
+
+    def changes(self, results):
+        """
+        Join the indicators fetched for each document, yielding
+        ``(solr_id, totals)`` with the values that differ from the indexed
+        ones. The indicators that could not be fetched are counted in
+        ``self.failures``.
+        """
+        pending = {}
+
+        for indicator, solr_id, doc, total in results:
+            fetched = pending.setdefault(solr_id, {})
+            fetched[indicator] = total
+
+            if len(fetched) < len(self.fields):
+                continue
+
+            del pending[solr_id]
+
+            totals = {}
+            for name, value in fetched.items():
+                field = self.fields[name]
+
+                if value is None:
+                    self.failures += 1
+                elif str(doc.get(field)) != str(value):
+                    totals[field] = value
+
+            yield solr_id, totals
+
+    def complete(self):
+        """
+        Tell whether every count of the last run was loaded or queued for
+        backfill, and every update was accepted by Solr. Otherwise the
+        documents whose counts failed or whose updates were dropped would
+        only be refreshed by the next full sweep, so the watermark is not
+        advanced.
+        """
+        if self.dropped:
+            return False
+
+        return not self.failures or self.backfill is not None
+
+    def run(self):
+        """
+        Run the process for update article in Solr.
+        """
+
+        logger.info("Loading Solr available document ids and current %s" % (
+            ' and '.join(self.indicators)))
+        from_date = None if self.source == 'backfill' else self.from_date
+        query = build_query(self.collection, self.issn, from_date)
+
+        if from_date:
+            logger.info("Refreshing documents processed since %s" % from_date.strftime('%Y-%m-%d'))
+
+        identifiers = None
+        if self.source == 'articlemeta':
+            identifiers = (
+                (item.code, item.collection)
+                for item in clients.get(clients.ARTICLEMETA).documents(
+                    collection=self.collection,
+                    issn=self.issn,
+                    from_date=from_date.strftime('%Y-%m-%d') if from_date else None,
+                    only_identifiers=True
+                )
+            )
+        elif self.source == 'backfill':
+            identifiers = self.backfill.pending(list(self.indicators))
+            logger.info("Loading %d documents queued for backfill" % len(identifiers))
+
+        fields = ','.join(sorted(self.fields.values()))
+        if self.source == 'backfill':
+            documents = lookup_documents(self.solr, query, fields, identifiers)
+        else:
+            documents = indexed_documents(
+                self.solr, query, fields, self.page_size, identifiers)
+
+        changed = 0
+        unchanged = 0
+
+        logger.info("Recording {0} for documents in {1}".format(
+            ' and '.join(self.indicators), self.solr.url))
+
+        results = imap_unordered(
+            self.fetch, self.tasks(documents), workers=self.workers)
+
+        with BatchWriter(self.solr, self.batch_size, self.batch_bytes,
+                         self.flush_interval) as writer:
+
+            for solr_id, totals in self.changes(results):
+
+                if not totals:
+                    unchanged += 1
+                    writer.flush_expired()
+                    continue
+
+                changed += 1
+
+                writer.add(self.set_indicators(solr_id, totals))
+
+        self.dropped = writer.dropped
+
+        total = changed + unchanged
+        logger.info("Changed (%d) and unchanged (%d) documents, %.1f%% changed." % (
+            changed, unchanged, 100.0 * changed / total if total else 0))
+
+        # optimize the index
+        self.solr.commit()
+        self.solr.optimize()
+
+        if self.source == 'backfill' and self.complete():
+            self.backfill.done()
+
+
+def main(job='indicators', job_indicators=INDICATORS, usage=USAGE):
+    """
+    Command line of the indicators jobs.
+
+    With a single indicator the rate limits are given by ``--rate`` and
+    ``--max_in_flight``, otherwise by one pair of options per indicator, such
+    as ``--accesses_rate``.
+
+    :param job: job name of the watermark
+    :param job_indicators: indicators loaded by the job
+    :param usage: usage of the command line
+    """
+    parser = argparse.ArgumentParser(textwrap.dedent(usage))
+
+    parser.add_argument(
+        '-c', '--collection',
+        default=None,
+        help='use the acronym of the collection eg.: spa, scl, col.'
+    )
+
+    parser.add_argument(
+        '-i', '--issn',
+        default=None,
+        help='journal issn.'
+    )
+
+    parser.add_argument(
+        '-s', '--source',
+        default='solr',
+        choices=SOURCES,
+        help='read the documents from the ids available in Solr, from the ArticleMeta identifiers listing or from the --backfill queue (default solr).'
+    )
+
+    cache.add_arguments(parser)
+    indicators.add_arguments(parser)
+    indicators.add_window_arguments(parser)
+
+    parser.add_argument(
+        '--page_size',
+        type=int,
+        default=PAGE_SIZE,
+        help='number of ids read from Solr per request (default %d).' % PAGE_SIZE
+    )
+
+    parser.add_argument(
+        '-b', '--batch_size',
+        type=int,
+        default=BATCH_SIZE,
+        help='number of documents updated per Solr request (default %d).' % BATCH_SIZE
+    )
+
+    parser.add_argument(
+        '--batch_bytes',
+        type=int,
+        default=BATCH_BYTES,
+        help='maximum size in bytes of the updates sent to Solr per request (default %d).' % BATCH_BYTES
+    )
+
+    parser.add_argument(
+        '--flush_interval',
+        type=int,
+        default=FLUSH_INTERVAL,
+        help='maximum seconds the updates wait before being sent to Solr, 0 disables it (default %d).' % FLUSH_INTERVAL
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='number of threads fetching the %s counts (default 1).' % ' and '.join(job_indicators)
+    )
+
+    for indicator in job_indicators:
+        prefix = '' if len(job_indicators) == 1 else indicator + '_'
+
+        parser.add_argument(
+            '--%srate' % prefix,
+            dest='%s_rate' % indicator,
+            metavar=('%srate' % prefix).upper(),
+            type=float,
+            default=0,
+            help='maximum requests per second sent to the %s service (default no limit).' % SERVICES[indicator]
+        )
+
+        parser.add_argument(
+            '--%smax_in_flight' % prefix,
+            dest='%s_max_in_flight' % indicator,
+            metavar=('%smax_in_flight' % prefix).upper(),
+            type=int,
+            default=0,
+            help='maximum concurrent requests sent to the %s service (default no limit).' % SERVICES[indicator]
+        )
+
+    parser.add_argument(
+        '--logging_level',
+        '-l',
+        default=LOGGING_LEVEL,
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        help='Logggin level'
+    )
+
+    args = parser.parse_args()
+
+    if args.source == 'backfill' and not args.backfill:
+        parser.error('--source backfill requires the --backfill queue file.')
+
+    LOGGING['handlers']['console']['level'] = args.logging_level
+    for lg, content in LOGGING['loggers'].items():
+        content['level'] = args.logging_level
+
+    logging.config.dictConfig(LOGGING)
+
+    start = time.time()
+    started = datetime.now()
+    indicators_cache = cache.from_arguments(args)
+    watermark = indicators.watermark_from_arguments(args, job)
+    from_date = indicators.from_date_from_arguments(args, watermark)
+
+    try:
+        us = UpdateSearch(
+            collection=args.collection,
+            issn=args.issn,
+            page_size=args.page_size,
+            indicators_cache=indicators_cache,
+            source=args.source,
+            workers=args.workers,
+            accesses_rate=getattr(args, 'accesses_rate', 0),
+            accesses_max_in_flight=getattr(args, 'accesses_max_in_flight', 0),
+            citations_rate=getattr(args, 'citations_rate', 0),
+            citations_max_in_flight=getattr(args, 'citations_max_in_flight', 0),
+            batch_size=args.batch_size,
+            batch_bytes=args.batch_bytes,
+            flush_interval=args.flush_interval,
+            breakers=dict(
+                (i, indicators.breaker_from_arguments(
+                    args, SERVICES[i], args.workers))
+                for i in job_indicators),
+            backfill=indicators.backfill_from_arguments(args),
+            from_date=from_date,
+            indicators=job_indicators
+        )
+        us.run()
+
+        if not us.complete():
+            logger.warning("(%d) counts not loaded, the watermark is not advanced." % us.failures)
+        elif watermark is not None and args.source != 'backfill':
+            watermark.save(started, full=from_date is None)
+    except KeyboardInterrupt:
+        logger.critical("Interrupt by user")
+    finally:
+        if indicators_cache is not None:
+            indicators_cache.close()
+
+        # End Time
+        end = time.time()
+        logger.info("Duration {0} seconds.".format(end-start))
@@ -0,0 +1,478 @@
+# coding: utf-8
+import time
+import queue
+import logging
+import itertools
+import multiprocessing
+import threading
+import collections
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED)
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadLocalClient(object):
+    """
+    Keep one upstream client per thread.
+
+    The clients are created on demand, by calling ``factory`` the first time
+    a thread asks for one.
+
+    :param factory: callable returning a new client instance
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._local = threading.local()
+
+    def get(self):
+        client = getattr(self._local, 'client', None)
+
+        if client is None:
+            client = self.factory()
+            self._local.client = client
+
+        return client
+
+
+class SourceError(Exception):
+    """
+    Exception raised by the source iterable of a pipeline, wrapped by
+    ``guard_source`` to tell it apart from the errors of the pipes.
+    """
+
+    def __init__(self, error):
+        super(SourceError, self).__init__(error)
+        self.error = error
+
+
+def guard_source(items):
+    """
+    Yield the items of an iterable, raising its exceptions wrapped in
+    ``SourceError``.
+
+    A pipeline resumed after a document fails to be transformed must not be
+    resumed after its source fails, the source can not be iterated anymore.
+    """
+    items = iter(items)
+
+    while True:
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        except Exception as e:
+            raise SourceError(e)
+
+        yield item
+
+
+def process_context():
+    """
+    Return the multiprocessing context of the process pools.
+
+    The pools are created while the prefetch and stage threads are running,
+    and a child forked from a process with threads may inherit locks held by
+    them, such as the logging ones, and deadlock. The ``forkserver`` start
+    method forks the workers from a process without threads, ``spawn`` is
+    used where it is not available.
+    """
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        return multiprocessing.get_context('spawn')
+
+
+def imap_unordered(func, items, workers=1, max_pending=None, processes=False):
+    """
+    Apply ``func`` to every item using a pool of ``workers`` threads, or
+    processes when ``processes`` is set, yielding the results in order of
+    completion.
+
+    No more than ``max_pending`` items (default ``2 * workers``) are
+    submitted to the pool at the same time, so the items iterable is
+    consumed only as fast as the results are consumed and the memory stays
+    bounded.
+
+    With a single worker the items are processed sequentially in the
+    calling thread.
+
+    :param func: callable receiving one item
+    :param items: iterable of items
+    :param workers: number of threads
+    :param max_pending: maximum number of items in flight
+    :param processes: use a pool of processes started by
+    ``process_context``, ``func`` and the items must be picklable
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    max_pending = max(max_pending or workers * 2, workers)
+    items = iter(items)
+    if processes:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=process_context())
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+
+    try:
+        for item in itertools.islice(items, max_pending):
+            pending.add(executor.submit(func, item))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for item in itertools.islice(items, len(done)):
+                pending.add(executor.submit(func, item))
+
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+QUEUE_DEPTH = 100
+
+_END = object()
+
+
+class StageStats(object):
+    """
+    Busy and idle time of a stage of a ``StagedExecutor``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.elapsed = 0.0
+        self.idle = 0.0
+
+    @property
+    def busy(self):
+        return max(self.elapsed - self.idle, 0.0)
+
+    def __str__(self):
+        return "Stage %s: (%d) items, busy %.1fs, idle %.1fs (%.0f%% busy)." % (
+            self.name, self.items, self.busy, self.idle,
+            100 * self.busy / self.elapsed if self.elapsed else 0)
+
+
+class StagedExecutor(object):
+    """
+    Run a chain of stages, each one in its own thread, connected by bounded
+    queues.
+
+    Each stage is a ``(name, func)`` pair, where ``func`` receives an iterable
+    and returns an iterable. The first stage receives the source iterable and
+    the output of each stage feeds the next one, the output of the last stage
+    is consumed in the calling thread. So the network, the CPU and the
+    search engine work at the same time, while the queues of ``depth`` items
+    keep the memory bounded.
+
+    The time each stage spends waiting on its queues is accounted as idle
+    time, the remaining as busy time, and both are logged at the end of
+    ``run`` to show which stage is the bottleneck.
+
+    :param stages: list of ``(name, func)`` pairs
+    :param depth: size of the queues between the stages
+    """
+
+    def __init__(self, stages, depth=QUEUE_DEPTH):
+        self.stages = stages
+        self.depth = max(depth, 1)
+        self.stats = [StageStats(name) for name, func in stages]
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _get(self, in_queue, stats):
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                item = in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            finally:
+                stats.idle += time.time() - start
+
+            if item is _END:
+                return
+
+            yield item
+
+    def _put(self, out_queue, item, stats):
+        start = time.time()
+        try:
+            while not self._stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+        finally:
+            stats.idle += time.time() - start
+
+        return False
+
+    def _run_stage(self, func, items, stats, out_queue=None):
+        start = time.time()
+        try:
+            for item in func(items):
+                stats.items += 1
+                if out_queue is not None and not self._put(out_queue, item, stats):
+                    return
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            if out_queue is not None:
+                self._put(out_queue, _END, stats)
+            stats.elapsed += time.time() - start
+
+    def run(self, source):
+        """
+        Feed ``source`` to the stages and wait until all of them finish.
+
+        Errors raised by any stage stop the other stages and are raised
+        again in the calling thread.
+        """
+        queues = [queue.Queue(self.depth) for stage in self.stages[:-1]]
+        threads = []
+
+        for ndx, ((name, func), stats) in enumerate(zip(self.stages, self.stats)):
+            if ndx == 0:
+                items = source
+            else:
+                items = self._get(queues[ndx - 1], stats)
+
+            if ndx == len(self.stages) - 1:
+                break
+
+            thread = threading.Thread(
+                target=self._run_stage, args=(func, items, stats, queues[ndx]),
+                name=name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            self._run_stage(self.stages[-1][1], items, self.stats[-1])
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(1)
+
+        for stats in self.stats:
+            logger.info(str(stats))
+
+        if self._errors:
+            raise self._errors[0]
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the requests sent to an upstream service.
+
+    Each request takes a token from a bucket refilled with ``rate`` tokens per
+    second, holding at most ``burst`` tokens (default ``rate``), and no more
+    than ``max_in_flight`` requests run at the same time. Zero disables each
+    limit.
+
+    Use it as a context manager around each request, it may be shared by
+    threads.
+
+    :param rate: requests per second
+    :param max_in_flight: maximum number of concurrent requests
+    :param burst: size of the bucket
+    """
+
+    def __init__(self, rate=0, max_in_flight=0, burst=None):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self._in_flight = None
+        if max_in_flight:
+            self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _take(self):
+        """
+        Take a token, returning how long to wait for the next one when the
+        bucket is empty.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        if self._in_flight is not None:
+            self._in_flight.acquire()
+
+        if not self.rate:
+            return
+
+        wait_time = self._take()
+        while wait_time:
+            time.sleep(wait_time)
+            wait_time = self._take()
+
+    def release(self):
+        if self._in_flight is not None:
+            self._in_flight.release()
+
+    def releasing(self, func):
+        """
+        Wrap ``func`` to release the slot taken by ``acquire`` when it
+        returns, so a call abandoned by a ``CircuitBreaker`` timeout still
+        counts as in flight until it actually finishes.
+        """
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.release()
+
+        return wrapper
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised by ``CircuitBreaker.call`` when the upstream service is not called
+    because the circuit is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling an upstream service while it is failing.
+
+    The circuit opens when at least ``threshold`` of the last ``window``
+    calls failed or timed out, and while it is open the calls fail at once
+    with ``CircuitOpenError``. After ``reset_timeout`` seconds a single probe
+    call is let through (half-open): the circuit closes when it succeeds and
+    opens again when it fails.
+
+    With ``timeout`` each call runs in one of ``concurrency`` helper threads
+    and fails with ``concurrent.futures.TimeoutError`` after that many
+    seconds, the call itself is abandoned and not interrupted. It may be
+    shared by threads, ``concurrency`` is the number of threads calling it,
+    so the calls do not wait for a helper thread while their timeout runs.
+
+    :param name: upstream name, used in the logs
+    :param timeout: seconds each call may take, 0 disables it
+    :param threshold: ratio of failed calls opening the circuit
+    :param window: number of recent calls considered
+    :param reset_timeout: seconds the circuit stays open before a probe
+    :param concurrency: number of threads calling the breaker
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, timeout=0, threshold=0.5, window=20,
+                 reset_timeout=60, concurrency=1):
+        self.name = name
+        self.timeout = timeout
+        self.threshold = threshold
+        self.window = max(window, 1)
+        self.reset_timeout = reset_timeout
+        self.concurrency = max(concurrency, 1)
+        self.state = self.CLOSED
+        self.rejected = 0
+        self._results = collections.deque(maxlen=self.window)
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def allow(self):
+        """
+        Return whether a call may be sent now, turning the circuit half-open
+        for the probe call once the reset timeout is over.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and \
+                    time.time() - self._opened >= self.reset_timeout:
+                logger.info("Circuit of %s half-open, probing." % self.name)
+                self.state = self.HALF_OPEN
+                return True
+
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                logger.info("Circuit of %s closed." % self.name)
+                self.state = self.CLOSED
+                self._results.clear()
+
+            self._results.append(True)
+
+    def failure(self):
+        with self._lock:
+            self._results.append(False)
+            failures = self._results.count(False)
+
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    len(self._results) == self.window and
+                    failures >= self.threshold * self.window):
+                logger.warning("Circuit of %s open for %d seconds." % (
+                    self.name, self.reset_timeout))
+                self.state = self.OPEN
+                self._opened = time.time()
+                self._results.clear()
+
+    def _run(self, func, args, kwargs):
+        if not self.timeout:
+            return func(*args, **kwargs)
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency,
+                    thread_name_prefix='breaker-%s' % self.name)
+
+        return self._executor.submit(func, *args, **kwargs).result(self.timeout)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)`` through the circuit.
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+        try:
+            result = self._run(func, args, kwargs)
+        except Exception:
+            self.failure()
+            raise
+
+        self.success()
+
+        return result
@@ -0,0 +1,300 @@
+# coding: utf-8
+import json
+import time
+import logging
+import threading
+
+from lxml import etree as ET
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+BATCH_BYTES = 8 * 1024 * 1024
+FLUSH_INTERVAL = 60
+RETRIES = 3
+RETRY_BACKOFF = 1.0
+TIMEOUT = 60
+
+
+def rejected(response):
+    """
+    Tell whether the body of a Solr update response, in JSON or XML, reports
+    an error. SolrAPI returns the body without checking the HTTP status.
+    """
+    if not response:
+        return False
+
+    if isinstance(response, bytes):
+        response = response.decode('utf-8', 'replace')
+
+    try:
+        data = json.loads(response)
+    except ValueError:
+        pass
+    else:
+        if not isinstance(data, dict):
+            return False
+
+        return 'error' in data or data.get('responseHeader', {}).get('status', 0) != 0
+
+    try:
+        xml = ET.fromstring(response.encode('utf-8'))
+    except ET.XMLSyntaxError:
+        return False
+
+    status = xml.findtext('./lst[@name="responseHeader"]/int[@name="status"]')
+
+    return xml.find('./lst[@name="error"]') is not None or status not in (None, '0')
+
+
+class BatchWriter(object):
+    """
+    Buffer ``<doc>`` elements and post them to Solr inside a single ``<add>``.
+
+    The buffer is flushed when it reaches ``batch_size`` documents or
+    ``batch_bytes`` serialized bytes, ``flush_interval`` seconds after the
+    previous flush, and when the writer is closed. Use it as
+    a context manager so the pending documents are also sent when the process
+    is interrupted.
+
+    With ``commit_within`` each ``<add>`` asks Solr to commit the documents
+    within that many milliseconds, instead of an explicit commit per request.
+
+    ``on_flush`` is called with the number of documents after every batch
+    accepted by Solr, such as to checkpoint the progress of a harvest.
+
+    Ids to be removed are buffered in the same way and sent inside a single
+    ``<delete>`` with up to ``batch_size`` ``<id>`` elements.
+
+    A batch rejected by Solr is split in halves which are sent again, until
+    the rejected documents are isolated, so a malformed document does not
+    discard the rest of its batch. Transport errors, such as Solr being
+    unavailable or a timeout, do not depend on the documents, so the whole
+    batch is sent again up to ``retries`` times, waiting ``backoff`` seconds
+    doubled at each attempt, and dropped when every attempt fails. The
+    documents and ids not accepted by Solr are counted in ``dropped``.
+
+    The writer may be shared by threads.
+
+    :param solr: SolrAPI.Solr instance
+    :param batch_size: maximum number of documents per request
+    :param batch_bytes: maximum size in bytes of the documents per request
+    :param flush_interval: maximum seconds between flushes, 0 disables it
+    :param commit_within: ``commitWithin`` milliseconds of each ``<add>``, 0
+    disables it
+    :param on_flush: callable receiving the number of documents of each batch
+    accepted by Solr
+    :param retries: number of times a batch is sent again after a transport
+    error
+    :param backoff: seconds before the first retry
+    """
+
+    def __init__(self, solr, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES,
+                 flush_interval=0, commit_within=0, on_flush=None,
+                 retries=RETRIES, backoff=RETRY_BACKOFF):
+        self.solr = solr
+        self.batch_size = max(batch_size, 1)
+        self.batch_bytes = max(batch_bytes, 1)
+        self.flush_interval = flush_interval
+        self.commit_within = commit_within
+        self.on_flush = on_flush
+        self.retries = max(retries, 0)
+        self.backoff = backoff
+        self.total = 0
+        self.requests = 0
+        self.deleted = 0
+        self.dropped = 0
+        self.delete_time = 0.0
+        self._docs = []
+        self._bytes = 0
+        self._deletes = []
+        self._flushed = time.time()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc):
+        """
+        Append a document to the buffer, flushing it when a limit is reached.
+
+        :param doc: ``<doc>`` lxml element or its serialized bytes
+        """
+        if not isinstance(doc, bytes):
+            doc = ET.tostring(doc, encoding="utf-8", method="xml")
+
+        with self._lock:
+            if self._docs and self._bytes + len(doc) > self.batch_bytes:
+                self.flush()
+
+            self._docs.append(doc)
+            self._bytes += len(doc)
+
+            if len(self._docs) >= self.batch_size or self._expired():
+                self.flush()
+
+    def _expired(self):
+        if not self.flush_interval:
+            return False
+
+        return time.time() - self._flushed >= self.flush_interval
+
+    def flush_expired(self):
+        """
+        Flush the pending documents when ``flush_interval`` seconds have
+        passed since the previous flush. Jobs that skip documents call it for
+        the skipped ones, so the pending documents are not held by a long run
+        of documents that are not added.
+        """
+        with self._lock:
+            if self._docs and self._expired():
+                self.flush()
+
+    def add_stream(self, docs):
+        """
+        Add every document of ``docs``, yielding each one once it is
+        buffered. It is the write stage of a
+        ``updatesearch.workers.StagedExecutor``.
+
+        :param docs: iterable of ``<doc>`` lxml elements or serialized bytes
+        """
+        for doc in docs:
+            self.add(doc)
+            yield doc
+
+    def flush(self):
+        """
+        Post the buffered documents to Solr in a single request.
+        """
+        with self._lock:
+            docs = self._docs
+            self._docs = []
+            self._bytes = 0
+            self._flushed = time.time()
+
+        if not docs:
+            return
+
+        logger.debug("Sending batch of (%d) documents to search index." % len(docs))
+        accepted = self._post(docs, self._add_xml)
+
+        self.total += accepted
+
+        if accepted and self.on_flush is not None:
+            self.on_flush(accepted)
+
+    def _add_xml(self, docs):
+        add = b'<add>'
+        if self.commit_within:
+            add = b'<add commitWithin="%d">' % self.commit_within
+
+        return b''.join([add] + docs + [b'</add>'])
+
+    def _delete_xml(self, ids):
+        xml = ET.Element('delete')
+
+        for document_id in ids:
+            identifier = ET.Element('id')
+            identifier.text = document_id
+            xml.append(identifier)
+
+        return ET.tostring(xml, encoding="utf-8", method="xml")
+
+    def _update(self, data):
+        """
+        Post a request body to Solr, sending it again after transport errors.
+        The error of the last attempt is raised.
+        """
+        for attempt in range(self.retries):
+            try:
+                return self.solr.update(data, commit=False)
+            except (IOError, OSError) as e:
+                delay = self.backoff * 2 ** attempt
+                logger.warning("Error: {0}, retrying in {1:.1f}s.".format(e, delay))
+                time.sleep(delay)
+
+        return self.solr.update(data, commit=False)
+
+    def _post(self, items, envelope):
+        """
+        Post the items in a single request, splitting it in halves while Solr
+        rejects it. Returns the number of items accepted.
+
+        :param items: serialized documents or ids
+        :param envelope: callable building the request body of the items
+        """
+        try:
+            response = self._update(envelope(items))
+        except (IOError, OSError) as e:
+            logger.error("Error: %s, dropping batch of (%d) items." % (e, len(items)))
+            logger.exception(e)
+            self.dropped += len(items)
+            return 0
+        except Exception as e:
+            logger.error("Error: {0}".format(e))
+            response = e
+        else:
+            if not rejected(response):
+                self.requests += 1
+                return len(items)
+
+        if len(items) == 1:
+            logger.error("Rejected by search index: %r, %s" % (items[0][:200], response))
+            self.dropped += 1
+            return 0
+
+        half = len(items) // 2
+
+        return self._post(items[:half], envelope) + self._post(items[half:], envelope)
+
+    def delete(self, document_id):
+        """
+        Append an id to the removal buffer, flushing it when it reaches
+        ``batch_size`` ids.
+
+        :param document_id: Solr document id
+        """
+        with self._lock:
+            self._deletes.append(document_id)
+
+            if len(self._deletes) >= self.batch_size:
+                self.flush_deletes()
+
+    def flush_deletes(self):
+        """
+        Remove the buffered ids from Solr in a single request.
+        """
+        with self._lock:
+            ids = self._deletes
+            self._deletes = []
+
+        if not ids:
+            return
+
+        logger.debug("Removing batch of (%d) documents from search index." % len(ids))
+        start = time.time()
+        try:
+            self.deleted += self._post(ids, self._delete_xml)
+        finally:
+            self.delete_time += time.time() - start
+
+    def close(self):
+        """
+        Flush the pending documents and ids to be removed.
+        """
+        self.flush()
+        self.flush_deletes()
+        logger.info("Sent (%d) documents in (%d) requests." % (self.total, self.requests))
+
+        if self.deleted:
+            logger.info("Removed (%d) documents, %.1f ids per second." % (
+                self.deleted, self.deleted / max(self.delete_time, 0.001)))
+
+        if self.dropped:
+            logger.error("Dropped (%d) documents and ids not accepted by the search index." % self.dropped)